@@ -25,8 +25,13 @@ import werkzeug.local
 import flask.helpers
 import sqlalchemy as sa
 import contextlib
+import itertools
+import time
+import threading
+import weakref
 from . import sessions
 from . import web
+from . import expression
 
 class Asgard(object):
 
@@ -43,6 +48,14 @@ class Asgard(object):
         The engine used to connect to the database.
         """
         self.engine = None
+        """
+        The engines used to connect to the read-only replicas of the database.
+        """
+        self.replica_engines = []
+        self._replica_counter = itertools.count()
+        self._replicas_down = {}
+        self._replica_retry_delay = 30
+        self._pool_stats = weakref.WeakKeyDictionary()
 
         self._conn_stack = werkzeug.local.LocalStack()
         """
@@ -53,6 +66,10 @@ class Asgard(object):
         The metadata object containing all the information about the db schema.
         """
         self.metadata = sa.MetaData()
+        """
+        The cache of the SAQL expressions used while this application is active.
+        """
+        self.expression_cache = expression.ExpressionCache()
 
         self.sessions_table = sessions.create_sessions_table(self.metadata)
         self.session_handler = sessions.SessionHandler(self)
@@ -83,48 +100,162 @@ class Asgard(object):
             self.root_path = config["root_path"]
         self.configure_database(self.config.setdefault("database", {}))
         self.configure_web(self.config.setdefault("web", {}))
+        self.configure_expressions(self.config.setdefault("expressions", {}))
         for plugin in self._plugins:
             plugin[1].configure(config.setdefault(plugin[0].config_key, {}))
 
     def configure_database(self, config):
+        """
+        Creates the engines. Besides the ``sqlalchemy.*`` options given to ``engine_from_config()``, the
+        configuration can contain a list of ``replicas`` URLs, used by read-only transactions, and a
+        ``replica_retry_delay`` in seconds during which a replica that could not be reached is not used.
+
+        The pools of the engines can be tuned with ``pool_pre_ping``, to test connections before handing them
+        out, ``pool_recycle``, the number of seconds after which connections are replaced, and ``pool_warmup``,
+        the number of connections to open right away in each pool.
+        """
         config.setdefault("sqlalchemy.url", 'sqlite://')
-        self.engine = sa.engine_from_config(config)
+        config.setdefault("replicas", [])
+        config.setdefault("replica_retry_delay", 30)
+        config.setdefault("pool_warmup", 0)
+        # only given when set, so the ``sqlalchemy.*`` options keep applying otherwise
+        options = dict((key, config[key]) for key in ["pool_pre_ping", "pool_recycle"] if key in config)
+        self.engine = sa.engine_from_config(config, **options)
+        self.replica_engines = [sa.engine_from_config(dict(config, **{"sqlalchemy.url": url}), **options)
+            for url in config["replicas"]]
+        self._replicas_down = {}
+        self._replica_retry_delay = config["replica_retry_delay"]
+        self._warm_up(self.engine, config["pool_warmup"])
+        for index, engine in enumerate(self.replica_engines):
+            try:
+                self._warm_up(engine, config["pool_warmup"])
+            except sa.exc.DBAPIError:
+                self._replicas_down[index] = time.time() + self._replica_retry_delay
+
+    def _warm_up(self, engine, number):
+        """
+        Opens ``number`` connections at the same time and gives them back to the pool.
+        """
+        self._engine_pool_stats(engine)
+        connections = []
+        try:
+            for i in range(number):
+                connections.append(engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
 
     def configure_web(self, config):
         self.web_app.config.update(**config)
 
+    def configure_expressions(self, config):
+        """
+        Sets the ``cache_size`` of the cache of SAQL expressions. If a ``persistent_cache`` path is given, the
+        parse trees are also stored in that SQLite file, see ``ExpressionCache.persist()``.
+        """
+        config.setdefault("cache_size", expression.CACHE_SIZE)
+        config.setdefault("persistent_cache", None)
+        self.expression_cache.resize(config["cache_size"])
+        self.expression_cache.persist(config["persistent_cache"])
+
     def create_tables(self):
         self.metadata.create_all(self.engine)
 
+    def _connect(self, readonly):
+        """
+        Returns a new connection. Read-only connections are opened on the replicas, in turn, skipping the ones that
+        could not be reached recently and the ones whose pool is exhausted. If no replica is available, the
+        connection is opened on the primary database.
+        """
+        if readonly and len(self.replica_engines) > 0:
+            start = next(self._replica_counter)
+            for i in range(len(self.replica_engines)):
+                index = (start + i) % len(self.replica_engines)
+                if self._replicas_down.get(index, 0) > time.time():
+                    continue
+                try:
+                    return self._checkout(self.replica_engines[index])
+                except sa.exc.TimeoutError:
+                    # the replica is busy, not down
+                    continue
+                except sa.exc.DBAPIError:
+                    self._replicas_down[index] = time.time() + self._replica_retry_delay
+        return self._checkout(self.engine)
+
+    def _checkout(self, engine):
+        """
+        Gets a connection from the pool of ``engine``, recording the time spent waiting for it.
+        """
+        stats = self._engine_pool_stats(engine)
+        start = time.time()
+        try:
+            connection = engine.connect()
+        except sa.exc.TimeoutError:
+            stats.timeout()
+            raise
+        stats.waited(time.time() - start)
+        return connection
+
+    def _engine_pool_stats(self, engine):
+        # two instances would both listen to the events of the pool
+        with _pool_stats_lock:
+            if engine not in self._pool_stats:
+                self._pool_stats[engine] = PoolStats(engine)
+            return self._pool_stats[engine]
+
+    def pool_stats(self):
+        """
+        Returns the live statistics of the connection pools, as a dictionary with the statistics of the ``primary``
+        database and the list of those of the ``replicas``. See ``PoolStats.stats()``.
+        """
+        return {
+            "primary": self._engine_pool_stats(self.engine).stats(),
+            "replicas": [self._engine_pool_stats(engine).stats() for engine in self.replica_engines],
+        }
+
     @contextlib.contextmanager
-    def transaction(self):
+    def transaction(self, readonly=False):
         """
         A context manager that initializes a connection and store it in the ``conn`` proxy. When the operations
         terminate normally, the transaction is commited. If there is an exception, the transaction is rollbacked.
+
+        The connection is only checked out from the pool, and the transaction begun, when the ``conn`` proxy is
+        used for the first time. If it is never used, nothing is sent to the database.
+
+        If ``readonly`` is true, the connection is opened on one of the replicas of the database, if any. Such
+        transactions must not modify the database and may not see the latest modifications.
         """
         assert self._conn_stack.top is None, "Only one connection can be opened at the same time"
-        self._conn_stack.push(self.engine.connect())
+        lazy_connection = _LazyConnection(self, readonly)
+        self._conn_stack.push(lazy_connection)
         try:
-            self.conn.current_transaction = self.conn.begin()
             try:
                 yield
-                self.conn.current_transaction.commit()
+                if lazy_connection.connected:
+                    lazy_connection.current_transaction.commit()
             except:
-                self.conn.current_transaction.rollback()
+                if lazy_connection.connected:
+                    lazy_connection.current_transaction.rollback()
                 raise
+            for callback in lazy_connection.on_commit:
+                callback()
         finally:
             try:
-                self.conn.close()
+                if lazy_connection.connected:
+                    lazy_connection.close()
             except:
                 pass
             self._conn_stack.pop()
 
-    def transactional(self, func):
+    def transactional(self, func=None, readonly=False):
         """
-        A decorator that will call ``transaction`` before the invocation of the function.
+        A decorator that will call ``transaction`` before the invocation of the function. It can also be used as
+        ``transactional(readonly=True)`` to use a read-only transaction.
         """
+        if func is None:
+            return lambda func: self.transactional(func, readonly)
         def alt(*args, **kwargs):
-            with self.transaction():
+            with self.transaction(readonly):
                 return func(*args, **kwargs)
         alt.__name__ = func.__name__
         alt.__module__ = func.__module__
@@ -145,9 +276,11 @@ class Asgard(object):
 
     def __enter__(self):
         _app_stack.push(self)
+        expression._cache_stack.push(self.expression_cache)
         return self
 
     def __exit__(self, *args, **kwargs):
+        expression._cache_stack.pop()
         _app_stack.pop()
 
     def declare_session(self, sid=None):
@@ -169,6 +302,112 @@ class Asgard(object):
         self._plugins.append((plugin_class, p))
         return p
 
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+_pool_stats_lock = threading.Lock()
+
+class PoolStats(object):
+    """
+    Statistics about the connection pool of an engine, maintained using the pool events.
+    """
+    def __init__(self, engine):
+        # the pool is replaced when the engine is disposed, a weak reference avoids keeping the engine alive
+        self._engine = weakref.ref(engine)
+        self._lock = threading.Lock()
+        self._checked_out = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_counts = [0] * (len(POOL_WAIT_BUCKETS) + 1)
+        sa.event.listen(engine, "checkout", self._on_checkout)
+        sa.event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self._checked_out += 1
+            self._checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._checked_out -= 1
+
+    def waited(self, seconds):
+        index = len(POOL_WAIT_BUCKETS)
+        for i, bound in enumerate(POOL_WAIT_BUCKETS):
+            if seconds <= bound:
+                index = i
+                break
+        with self._lock:
+            self._wait_counts[index] += 1
+
+    def timeout(self):
+        with self._lock:
+            self._timeouts += 1
+
+    def stats(self):
+        """
+        Returns a dictionary containing:
+
+        * ``checked_out``: the number of connections currently used.
+        * ``checkouts``: the number of times a connection was given by the pool.
+        * ``overflow``: the number of connections opened beyond the size of the pool, ``None`` if the pool does not
+          have a fixed size.
+        * ``timeouts``: the number of times no connection could be obtained in time.
+        * ``wait_histogram``: a list of ``(bound, count)`` tuples giving the number of connections obtained in less
+          than ``bound`` seconds, and more than the previous bound. The last bound is ``None``.
+        """
+        engine = self._engine()
+        pool = engine.pool if engine is not None else None
+        with self._lock:
+            return {
+                "checked_out": self._checked_out,
+                "checkouts": self._checkouts,
+                "overflow": pool.overflow() if isinstance(pool, sa.pool.QueuePool) else None,
+                "timeouts": self._timeouts,
+                "wait_histogram": list(zip(POOL_WAIT_BUCKETS + (None,), self._wait_counts)),
+            }
+
+class _LazyConnection(object):
+    """
+    The object stored in the ``conn`` proxy by ``Asgard.transaction()``. It behaves like a SqlAlchemy connection
+    but only opens it, and begins a transaction, when one of its attributes is accessed for the first time.
+    """
+    def __init__(self, app, readonly):
+        self._app = app
+        # true if the connection may be opened on a replica
+        self.readonly = readonly
+        self._connection = None
+        self._transaction = None
+        # records cached by the table managers, they are forgotten with the connection
+        self.identity_map = {}
+        # functions to call once the transaction is commited
+        self.on_commit = []
+        # tables modified in the transaction, the result caches of the table managers ignore them until the commit
+        self.result_cache_writes = set()
+
+    @property
+    def connected(self):
+        return self._connection is not None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            connection = self._app._connect(self.readonly)
+            try:
+                self._transaction = connection.begin()
+            except:
+                connection.close()
+                raise
+            self._connection = connection
+        return self._connection
+
+    @property
+    def current_transaction(self):
+        self.connection
+        return self._transaction
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
 class Plugin(object):
     
     config_key = None
@@ -99,78 +99,217 @@ import sqlalchemy as sa
 import sqlalchemy.sql as sql
 import sqlalchemy.sql.expression as expr
 import operator
-from pyparsing import *
 import ast
+import re
+import time
+import math
+import decimal
+import hashlib
+import sqlite3
+import threading
+import atexit
+import weakref
+import os
 import pylru
+import werkzeug.local
 
 CACHE_SIZE = 200
 
-class _NoneVal(object):
-    pass
-
-_none_val = _NoneVal()
-
-def _define_parser():
-    ParserElement.enablePackrat()
-
-    identifier_part = Word(alphas + "_", alphanums + "_")
-    identifier = delimitedList(identifier_part, ".").setParseAction(lambda x: ('identifier', ".".join(x)))
-
-    variable = Combine(":" + Word(alphas + "_", alphanums + "_")).setParseAction(lambda x: ('variable', x[0][1:]))
-
-    boolean_literal = (Keyword("true") | Keyword("false")).setParseAction(lambda x: x[0] == "true")
-    integer_literal = Word(nums).setParseAction(lambda x: int(x[0]))
-    float_literal = Combine(Word(nums) + "." + Optional(Word(nums))).setParseAction(lambda x: float(x[0]))
-    string_literal = quotedString.setParseAction(lambda x: ast.literal_eval(x[0]))
-    null_literal = Keyword("null").setParseAction(lambda x: _none_val)
-
-    literal = (boolean_literal | string_literal | float_literal | integer_literal | null_literal).setParseAction(lambda x: ('literal', x[0]))
-
-    logical_or = Keyword("or")
-    logical_and = Keyword("and")
-    equality = Literal("==") | Literal("!=") | Keyword("in") | Keyword("like") | Keyword("ilike")
-    relational = Literal("<=") | Literal(">=") | Literal("<") | Literal(">")
-    additive = Literal("+") | Literal("-")
-    mult = Literal("*") | Literal("/") | Literal("%")
-    non = Keyword("not")
-
-    expression = Forward()
-
-    # can we put a trailing comma?
-    list_expr = ("[" + delimitedList(expression) + "]").setParseAction(lambda x: ('list', x[1:-1]))
-
-    rvalue = literal | identifier | variable | list_expr
+"""
+The version of the SAQL grammar, to increment each time the parse trees produced by the parser change. The trees
+stored by ``TreeStore`` for other versions are ignored.
+"""
+GRAMMAR_VERSION = 1
 
-    def op1_action(x):
-        x = x[0]
-        assert len(x) == 2
-        return ('op1', x[0], x[1])
+"""
+The number of seconds between two writes of the new parse trees by ``TreeStore``.
+"""
+STORE_FLUSH_INTERVAL = 5
 
-    def op2_action(x):
-        x = x[0]
-        if len(x) == 1:
-            return x
-        return op2_action([[('op2', x[1], x[0], x[2])] + x[3:]])
+"""
+Prefix of the names of the bind parameters created for variables when using ``bind_variables``.
+"""
+VARIABLE_PREFIX = "saql_"
 
-    expression << operatorPrecedence(rvalue, [
-            (additive, 1, opAssoc.RIGHT, op1_action),
-            (non, 1, opAssoc.RIGHT, op1_action),
-            (mult, 2, opAssoc.LEFT, op2_action),
-            (additive, 2, opAssoc.LEFT, op2_action),
-            (relational, 2, opAssoc.LEFT, op2_action),
-            (equality, 2, opAssoc.LEFT, op2_action),
-            (logical_and, 2, opAssoc.LEFT, op2_action),
-            (logical_or, 2, opAssoc.LEFT, op2_action),
-        ])
+class _NoneVal(object):
+    pass
 
-    program = expression + stringEnd
+_none_val = _NoneVal()
 
-    return program
+class ParseException(Exception):
+    """
+    Raised when an expression is not valid SAQL. ``loc`` is the position in the expression where the error was
+    detected.
+    """
+    def __init__(self, expression, loc, msg):
+        super(ParseException, self).__init__("%s (at char %d) in expression: %s" % (msg, loc, expression))
+        self.loc = loc
+
+_ident_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
+
+_token_regex = re.compile(r"""[ \t\n\r]*(?:
+    (?P<string>"(?:[^"\n\r\\]|""|\\(?:[^x]|x[0-9a-fA-F]+))*"|'(?:[^'\n\r\\]|''|\\(?:[^x]|x[0-9a-fA-F]+))*')
+    |(?P<number>[0-9]+\.[0-9]+(?![%(ident)s])|[0-9]+\.|[0-9]+(?![%(ident)s]))
+    |(?P<variable>:[a-zA-Z_][%(ident)s]*)
+    |(?P<word>[a-zA-Z_][%(ident)s]*)
+    |(?P<symbol>==|!=|<=|>=|[-<>+*/%%()\[\],.])
+    )""" % {"ident": _ident_chars}, re.VERBOSE)
+
+_whitespace_regex = re.compile(r"[ \t\n\r]*")
+
+_binary_precedence = {
+    "or": 0,
+    "and": 1,
+    "==": 2, "!=": 2, "in": 2, "like": 2, "ilike": 2,
+    "<=": 3, ">=": 3, "<": 3, ">": 3,
+    "+": 4, "-": 4,
+    "*": 5, "/": 5, "%": 5,
+}
 
-_parser = _define_parser()
+_word_operators = set(["or", "and", "in", "like", "ilike"])
+
+def _tokenize(expression):
+    """
+        Splits an expression in a list of ``(kind, text, position)`` tuples, terminated by an ``end`` token.
+    """
+    tokens = []
+    pos = 0
+    end = len(expression)
+    while True:
+        pos = _whitespace_regex.match(expression, pos).end()
+        if pos == end:
+            break
+        match = _token_regex.match(expression, pos)
+        if match is None:
+            raise ParseException(expression, pos, "Unexpected character")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind), match.start(kind)))
+        pos = match.end()
+    tokens.append(("end", None, end))
+    return tokens
+
+class _Parser(object):
+    """
+    A precedence-climbing parser for SAQL. It produces trees of tuples, like ``('op2', '+', ('literal', 1),
+    ('identifier', 'a'))``.
+
+    From the tightest to the loosest, the operators are: the unary ``+`` and ``-``, ``not``, ``*``, ``/`` and
+    ``%``, the binary ``+`` and ``-``, the comparisons, ``==``, ``!=``, ``in``, ``like`` and ``ilike``, ``and``,
+    then ``or``. All binary operators are left-associative. Words that can not be read as literals are always
+    identifiers, even those spelled like operators.
+    """
+
+    def parseString(self, expression):
+        """
+        Parses an expression and returns a list containing its tree, like the pyparsing grammar that this parser
+        replaced.
+        """
+        # as pyparsing did, for the positions in the messages to be identical
+        expression = expression.expandtabs()
+        tokens = _tokenize(expression)
+        parse = _Parse(expression, tokens)
+        tree = parse.expression(0)
+        parse.expect("end")
+        return [tree]
+
+class _Parse(object):
+    def __init__(self, expression, tokens):
+        self.text = expression
+        self.tokens = tokens
+        self.pos = 0
+
+    def error(self, msg):
+        raise ParseException(self.text, self.tokens[self.pos][2], msg)
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def accept(self, kind, text=None):
+        token = self.tokens[self.pos]
+        if token[0] == kind and (text is None or token[1] == text):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, kind, text=None):
+        token = self.accept(kind, text)
+        if token is None:
+            self.error("Expected %s" % (text or kind))
+        return token
+
+    def binary_operator(self):
+        kind, text, loc = self.tokens[self.pos]
+        if (kind == "symbol" and text in _binary_precedence) or (kind == "word" and text in _word_operators):
+            return text
+        return None
+
+    def expression(self, min_precedence):
+        left = self.negation()
+        while True:
+            op = self.binary_operator()
+            if op is None or _binary_precedence[op] < min_precedence:
+                return left
+            self.pos += 1
+            right = self.expression(_binary_precedence[op] + 1)
+            left = ('op2', op, left, right)
+
+    def negation(self):
+        if self.peek()[0] == "word" and self.peek()[1] == "not":
+            start = self.pos
+            self.pos += 1
+            try:
+                return ('op1', "not", self.negation())
+            except ParseException:
+                # not followed by an operand, it is a column name
+                self.pos = start
+        return self.sign()
+
+    def sign(self):
+        kind, text, loc = self.peek()
+        if kind == "symbol" and text in ("+", "-"):
+            self.pos += 1
+            return ('op1', text, self.sign())
+        return self.operand()
+
+    def operand(self):
+        kind, text, loc = self.peek()
+        if kind == "end":
+            self.error("Unexpected end of expression")
+        self.pos += 1
+        if kind == "string":
+            return ('literal', ast.literal_eval(text))
+        elif kind == "number":
+            return ('literal', float(text) if "." in text else int(text))
+        elif kind == "variable":
+            return ('variable', text[1:])
+        elif kind == "word":
+            if text in ("true", "false"):
+                return ('literal', text == "true")
+            elif text == "null":
+                return ('literal', _none_val)
+            parts = [text]
+            while self.accept("symbol", "."):
+                parts.append(self.expect("word")[1])
+            return ('identifier', ".".join(parts))
+        elif kind == "symbol" and text == "[":
+            items = [self.expression(0)]
+            while self.accept("symbol", ","):
+                items.append(self.expression(0))
+            self.expect("symbol", "]")
+            return ('list', items)
+        elif kind == "symbol" and text == "(":
+            tree = self.expression(0)
+            self.expect("symbol", ")")
+            return tree
+        self.pos -= 1
+        self.error("Unexpected %s" % text)
+
+_parser = _Parser()
 
 def _in(elem1, elem2):
     assert isinstance(elem1, expr.ColumnElement), "Invalid left operand for 'in' operator: %s" % elem1
+    if isinstance(elem2, expr.BindParameter):
+        elem2 = sql.bindparam(elem2.key, expanding=True)
     return elem1.in_(elem2)
 
 def _like(elem1, elem2):
@@ -200,26 +339,530 @@ _operators = {
     "ilike": _ilike,
 }
 
-_cache = pylru.lrucache(CACHE_SIZE)
+class ExpressionCache(object):
+    """
+    A thread-safe LRU cache of the parse trees of expressions and of the clauses built by ``QueryBuilderHelper``,
+    counting its hits, misses and evictions, as well as the time spent parsing expressions.
+    """
+    def __init__(self, size=CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._trees = pylru.lrucache(size, self._evicted)
+        self._clauses = pylru.lrucache(size)
+        self._normalized = pylru.lrucache(size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parse_time = 0.
+        self.clause_hits = 0
+        self.clause_misses = 0
+        self._store = None
+
+    def _evicted(self, key, value):
+        self.evictions += 1
+
+    def persist(self, path):
+        """
+        Stores the parse trees in a SQLite file, shared by all the processes using the same path. The trees already
+        stored in the file are loaded right away, up to the size of the cache, then each newly parsed expression is
+        added to the file. If the file can not be opened, or if ``path`` is ``None``, the trees are not stored.
+
+        The file previously given to this method, if any, is closed.
+        """
+        store = None
+        if path is not None:
+            try:
+                store = TreeStore(path)
+            except sqlite3.Error:
+                pass
+        with self._lock:
+            previous, self._store = self._store, store
+            if store is not None:
+                for expression, tree in store.load(self._trees.size()):
+                    if expression not in self._trees:
+                        self._trees[expression] = tree
+        if previous is not None:
+            previous.close()
+
+    def flush(self):
+        """
+        Writes the trees not yet stored in the file given to ``persist()``, if any.
+        """
+        store = self._store
+        if store is not None:
+            store.flush()
+
+    def tree(self, expression):
+        """
+        Returns the parse tree of an expression, parsing it if it is not in the cache.
+        """
+        with self._lock:
+            try:
+                tree = self._trees[expression]
+                self.hits += 1
+                return tree
+            except KeyError:
+                self.misses += 1
+        start = time.time()
+        tree = _parser.parseString(expression)[0]
+        elapsed = time.time() - start
+        with self._lock:
+            self.parse_time += elapsed
+            self._trees[expression] = tree
+            store = self._store
+        if store is not None:
+            store.add(expression, tree)
+        return tree
+
+    def normalized(self, expression):
+        """
+        Returns the result of ``_normalize()`` for an expression, computing it if it is not in the cache.
+        """
+        with self._lock:
+            try:
+                return self._normalized[expression]
+            except KeyError:
+                pass
+        result = _normalize(self.tree(expression))
+        if result is None:
+            result = (expression, {})
+        with self._lock:
+            self._normalized[expression] = result
+        return result
+
+    def clause(self, key):
+        with self._lock:
+            try:
+                clause = self._clauses[key]
+                self.clause_hits += 1
+                return clause
+            except KeyError:
+                self.clause_misses += 1
+                return None
+
+    def set_clause(self, key, clause):
+        with self._lock:
+            self._clauses[key] = clause
+
+    def resize(self, size):
+        with self._lock:
+            self._trees.size(size)
+            self._clauses.size(size)
+            self._normalized.size(size)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self._clauses.clear()
+            self._normalized.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.parse_time = 0.
+            self.clause_hits = 0
+            self.clause_misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._trees),
+                "max_size": self._trees.size(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "parse_time": self.parse_time,
+                "clause_hits": self.clause_hits,
+                "clause_misses": self.clause_misses,
+            }
+
+class TreeStore(object):
+    """
+    A SQLite file containing parse trees, keyed by the hash of their expression and the version of the grammar.
+    Several processes can use the same file. As it is only a cache, the failures to read or write the file are
+    ignored, except when opening it.
+
+    The added trees are kept in memory and written by a background thread every ``flush_interval`` seconds, as
+    well as when the process exits or when the store is closed. A forked process opens its own connection to the
+    file.
+    """
+    def __init__(self, path, flush_interval=STORE_FLUSH_INTERVAL):
+        self._path = path
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._fork_lock = threading.Lock()
+        self._pending = []
+        self._flush_interval = flush_interval
+        self._thread = None
+        self._closed = False
+        self._pid = os.getpid()
+        # connections opened by parent processes, SQLite forbids to use them, or even close them, after a fork
+        self._inherited = []
+        self._connection = self._connect()
+        _open_stores.add(self)
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, timeout=1, check_same_thread=False)
+        try:
+            connection.execute("create table if not exists saql_trees (hash text not null, grammar integer "
+                "not null, expression text not null, tree text not null, primary key (hash, grammar))")
+            connection.commit()
+        except sqlite3.Error:
+            connection.close()
+            raise
+        return connection
+
+    def _check_fork(self):
+        """
+        Opens a new connection if the process was forked since the last call.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._fork_lock:
+            if self._pid == os.getpid():
+                return
+            # the locks may have been held by other threads of the parent process, which do not exist here
+            self._lock = threading.Lock()
+            self._pending_lock = threading.Lock()
+            # the parent process writes its own pending trees
+            self._pending = []
+            self._thread = None
+            if self._connection is not None:
+                self._inherited.append(self._connection)
+            try:
+                self._connection = self._connect() if not self._closed else None
+            except sqlite3.Error:
+                self._connection = None
+            self._pid = os.getpid()
+
+    def load(self, limit):
+        """
+        Returns a list of ``(expression, tree)`` tuples containing at most ``limit`` of the last stored trees.
+        """
+        self._check_fork()
+        try:
+            with self._lock:
+                if self._connection is None:
+                    return []
+                rows = self._connection.execute("select expression, tree from saql_trees where grammar = ? "
+                    "order by rowid desc limit ?", (GRAMMAR_VERSION, limit)).fetchall()
+        except sqlite3.Error:
+            return []
+        trees = []
+        for expression, tree in reversed(rows):
+            try:
+                trees.append((expression, _decode_tree(ast.literal_eval(tree))))
+            except (ValueError, SyntaxError):
+                pass
+        return trees
+
+    def add(self, expression, tree):
+        """
+        Adds a tree to the ones to write by the next flush.
+        """
+        self._check_fork()
+        with self._pending_lock:
+            if self._closed:
+                return
+            self._pending.append((expression, tree))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._flush_periodically)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _flush_periodically(self):
+        while not self._closed:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the added trees in the file.
+        """
+        self._check_fork()
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if len(pending) == 0:
+            return
+        rows = []
+        for expression, tree in pending:
+            key = hashlib.sha1(expression.encode("utf8") if isinstance(expression, unicode) else expression)
+            rows.append((key.hexdigest(), GRAMMAR_VERSION, expression, repr(_encode_tree(tree))))
+        try:
+            with self._lock:
+                if self._connection is None:
+                    return
+                self._connection.executemany("insert or ignore into saql_trees (hash, grammar, expression, tree) "
+                    "values (?, ?, ?, ?)", rows)
+                self._connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """
+        Writes the added trees and closes the file. The trees added afterwards are ignored.
+        """
+        self.flush()
+        with self._pending_lock:
+            self._closed = True
+            self._pending = []
+        with self._lock:
+            connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+        _open_stores.discard(self)
+
+_open_stores = weakref.WeakSet()
+
+@atexit.register
+def _flush_open_stores():
+    for store in list(_open_stores):
+        store.flush()
+
+def _encode_tree(elem):
+    """
+        Replaces the null literals by ``None``, for the trees to contain only Python literals.
+    """
+    if elem[0] == "literal":
+        return ('literal', None) if elem[1] is _none_val else elem
+    elif elem[0] == "list":
+        return ('list', [_encode_tree(e) for e in elem[1]])
+    elif elem[0] in ("op1", "op2"):
+        return elem[:2] + tuple([_encode_tree(e) for e in elem[2:]])
+    return elem
+
+def _decode_tree(elem):
+    if elem[0] == "literal":
+        return ('literal', _none_val) if elem[1] is None else elem
+    elif elem[0] == "list":
+        return ('list', [_decode_tree(e) for e in elem[1]])
+    elif elem[0] in ("op1", "op2"):
+        return elem[:2] + tuple([_decode_tree(e) for e in elem[2:]])
+    return elem
+
+"""
+The cache used when no Asgard application is active.
+"""
+default_cache = ExpressionCache(CACHE_SIZE)
+
+_cache_stack = werkzeug.local.LocalStack()
+
+def current_cache():
+    """
+    Returns the expression cache of the active Asgard application, or ``default_cache``.
+    """
+    cache = _cache_stack.top
+    return cache if cache is not None else default_cache
 
 def _compile(expression):
+    return current_cache().tree(expression)
+
+"""
+Prefix of the names of the variables created by ``normalize()`` for the literals of an expression.
+"""
+LITERAL_PREFIX = "__literal_"
+
+def normalize(expression, values=None):
+    """
+    Returns an expression equivalent to the given one and the values of its variables. The operands of chains of
+    ``and`` and ``or`` are sorted, constant arithmetic is computed and the literals compared to anything else than
+    a literal are replaced by variables, lists of literals given to ``in`` becoming a single variable. Expressions
+    differing only by the values of their literals thus give the same expression, producing the same statements
+    when using ``bind_variables``.
+
+    SqlAlchemy clauses and ``None`` are returned unchanged, as well as the expressions with literals when some
+    variables already use the names starting with ``LITERAL_PREFIX``.
+    """
+    if not isinstance(expression, (str, unicode)):
+        return expression, values
+    normalized, literals = current_cache().normalized(expression)
+    if len(literals) == 0:
+        return normalized, values
+    if any([k.startswith(LITERAL_PREFIX) for k in (values or {}).keys()]):
+        # the variables created for the literals would replace those of the caller
+        return expression, values
+    expression = normalized
+    values = dict(values or {})
+    values.update(literals)
+    return expression, values
+
+class _Unnormalizable(Exception):
+    pass
+
+def _normalize(tree):
+    """
+        Returns the normalized form of a tree as an expression and the dictionary of the variables created for its
+        literals, or ``None`` if the tree can not be written back as an expression.
+    """
+    literals = {}
     try:
-        return _cache[expression]
-    except KeyError:
-        pass
-    tree = _parser.parseString(expression)[0]
-    _cache[expression] = tree
-    return tree
+        return _format(_lift(_fold(tree), literals)), literals
+    except _Unnormalizable:
+        return None
+
+def _is_literal(elem):
+    return elem[0] == "literal" and elem[1] is not _none_val
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def _fold(elem):
+    """
+        Computes the constant arithmetic and sorts the operands of ``and`` and ``or``.
+    """
+    kind = elem[0]
+    if kind == "list":
+        return ('list', [_fold(e) for e in elem[1]])
+    elif kind == "op1":
+        operand = _fold(elem[2])
+        if elem[1] in ("+", "-") and _is_literal(operand) and _is_number(operand[1]):
+            return ('literal', + operand[1] if elem[1] == "+" else - operand[1])
+        return ('op1', elem[1], operand)
+    elif kind == "op2":
+        op = elem[1]
+        if op in ("and", "or"):
+            operands = sorted(_flatten(op, elem), key=lambda e: repr(_shape(e)))
+            result = operands[0]
+            for operand in operands[1:]:
+                result = ('op2', op, result, operand)
+            return result
+        elem1 = _fold(elem[2])
+        elem2 = _fold(elem[3])
+        if op in ("+", "-", "*", "/", "%") and _is_literal(elem1) and _is_literal(elem2):
+            value1, value2 = elem1[1], elem2[1]
+            if (_is_number(value1) and _is_number(value2)) or (op == "+" and isinstance(value1, (str, unicode))
+                    and type(value1) == type(value2)):
+                try:
+                    value = _operators[op](value1, value2)
+                except ArithmeticError:
+                    value = None
+                if value is not None and (not isinstance(value, float) or not (math.isinf(value) or
+                        math.isnan(value))):
+                    return ('literal', value)
+        return ('op2', op, elem1, elem2)
+    return elem
+
+def _flatten(op, elem):
+    if elem[0] == "op2" and elem[1] == op:
+        return _flatten(op, elem[2]) + _flatten(op, elem[3])
+    return [_fold(elem)]
+
+def _shape(elem):
+    """
+        Returns a representation of a tree ignoring the values of the literals.
+    """
+    kind = elem[0]
+    if kind == "literal":
+        return ('literal', type(elem[1]).__name__)
+    elif kind == "list":
+        return ('list', tuple([_shape(e) for e in elem[1]]))
+    elif kind in ("op1", "op2"):
+        return elem[:2] + tuple([_shape(e) for e in elem[2:]])
+    return elem
+
+def _lift(elem, literals):
+    """
+        Replaces the literals that are operands of a binary operator by variables, unless both operands are
+        literals.
+    """
+    if elem[0] == "op1":
+        return ('op1', elem[1], _lift(elem[2], literals))
+    if elem[0] != "op2":
+        return elem
+    op, elem1, elem2 = elem[1:]
+    if op == "in" and elem2[0] == "list" and not _is_literal(elem1):
+        if all([_is_literal(e) for e in elem2[1]]):
+            elem2 = _variable([e[1] for e in elem2[1]], literals)
+        else:
+            elem2 = ('list', [_variable(e[1], literals) if _is_literal(e) else _lift(e, literals)
+                for e in elem2[1]])
+    lift = not (_is_literal(elem1) and _is_literal(elem2))
+    elem1 = _variable(elem1[1], literals) if lift and _is_literal(elem1) else _lift(elem1, literals)
+    elem2 = _variable(elem2[1], literals) if lift and _is_literal(elem2) else _lift(elem2, literals)
+    return ('op2', op, elem1, elem2)
+
+def _variable(value, literals):
+    name = LITERAL_PREFIX + str(len(literals))
+    literals[name] = value
+    return ('variable', name)
+
+def _format(elem):
+    """
+        Writes a tree back as an expression, putting all operations between parenthesis.
+    """
+    kind = elem[0]
+    if kind == "identifier":
+        # the not operator would be read instead of a column named not
+        return elem[1] if elem[1].split(".")[0] != "not" else "(%s)" % elem[1]
+    elif kind == "variable":
+        return ":" + elem[1]
+    elif kind == "literal":
+        return _format_literal(elem[1])
+    elif kind == "list":
+        return "[%s]" % ", ".join([_format(e) for e in elem[1]])
+    elif kind == "op1":
+        return "(%s %s)" % (elem[1], _format(elem[2]))
+    elif kind == "op2":
+        return "(%s %s %s)" % (_format(elem[2]), elem[1], _format(elem[3]))
+    assert False, "should not happen"
+
+def _format_literal(value):
+    if value is _none_val:
+        return "null"
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, (int, long)):
+        return "%d" % value
+    elif isinstance(value, float):
+        if math.isinf(value) or math.isnan(value):
+            raise _Unnormalizable()
+        text = format(decimal.Decimal(value), "f")
+        return text if "." in text else text + "."
+    text = repr(value)
+    if text[0] not in "'\"":
+        raise _Unnormalizable()
+    return text
+
+def variable_params(values):
+    """
+    Returns the parameters to give when executing a clause created by a ``QueryBuilderHelper`` using
+    ``bind_variables``.
+    """
+    return dict([(VARIABLE_PREFIX + k, v) for k, v in (values or {}).items() if _bindable(v)])
+
+def variables_signature(values):
+    """
+    Returns a hashable object such that two dictionaries of variables having the same signature produce the same
+    clause when using ``bind_variables``, or ``None`` if the clause can not be reused.
+    """
+    values = values or {}
+    if any([isinstance(v, expr.ClauseElement) for v in values.values()]):
+        return None
+    return tuple(sorted([(k, type(v)) for k, v in values.items()]))
+
+def _untyped_bindparam(elem):
+    return isinstance(elem, expr.BindParameter) and isinstance(elem.type, sa.types.NullType)
+
+def _bindable(value):
+    return value is not None and not isinstance(value, expr.ClauseElement)
 
 class QueryBuilderHelper(object):
-    def __init__(self, table):
+    """
+    Set to false in subclasses resolving column names differently depending on the instance.
+    """
+    cache_clauses = True
+
+    def __init__(self, table, bind_variables=False):
         """
-        :param name: The SqlAlchemy Metadata object.
-        :param cache_size: The size of the cache to store compilation results. Can be deactivated by using ``0``.
+        :param table: The SqlAlchemy table to query.
+        :param bind_variables: If true, variables are replaced by bind parameters instead of their values, except
+            for ``null`` and SqlAlchemy clauses. The values must then be given at execution using
+            ``variable_params()``. The where-clause and from-clause of an expression are then cached, for a given
+            table and given types of values.
         """
         assert hasattr(table.c, "id"), "Table %s must contain a column named id" % table
         self.table = table
         self.fk_columns = {}
+        self.bind_variables = bind_variables
+        self._from_clause = None
 
     def where_clause(self, expression, values=None):
         values = values or {}
@@ -227,10 +870,24 @@ class QueryBuilderHelper(object):
             return expression
         elif expression is None:
             return None
+        key = None
+        # only a helper that did not resolve any foreign key yet can reuse the aliases of a cached clause
+        if self.bind_variables and self.cache_clauses and len(self.fk_columns) == 0:
+            signature = variables_signature(values)
+            if signature is not None:
+                key = (self.table, expression, signature)
+                cached = current_cache().clause(key)
+                if cached is not None:
+                    where_clause, fk_columns, from_clause = cached
+                    self.fk_columns = _copy_fk_columns(fk_columns)
+                    self._from_clause = from_clause
+                    return where_clause
         tree = _compile(expression)
         where_clause = self._walk(values, tree)
         if not isinstance(where_clause, expr.ClauseElement):
             where_clause = expr.literal(where_clause)
+        if key is not None:
+            current_cache().set_clause(key, (where_clause, _copy_fk_columns(self.fk_columns), self.from_clause()))
         return where_clause
 
     def _walk(self, values, elem):
@@ -239,7 +896,11 @@ class QueryBuilderHelper(object):
         if kind == "identifier":
             return self.column(val[0])
         elif kind == "variable":
-            return values[val[0]]
+            value = values[val[0]]
+            if self.bind_variables and _bindable(value):
+                # untyped, the comparisons give it the type of the column
+                return sql.bindparam(VARIABLE_PREFIX + val[0])
+            return value
         elif kind == "literal":
             return val[0] if val[0] != _none_val else None
         elif kind == "list":
@@ -275,12 +936,15 @@ class QueryBuilderHelper(object):
             fk_columns[column_name] = _JoinPart()
             fk_columns[column_name].table = table_alias
             fk_columns[column_name].fk_columns = {}
+            self._from_clause = None
         # an assertion to inform about an easy-to-avoid bug, it could be a good idea to fix this one day or later
         assert vals[1] != "id", "Querying the id of a row through a foreign key is not supported, use the foreign key instead"
         return self._column_walk(fk_columns[column_name], vals[1:])
 
     def from_clause(self):
-        return self._walk_tables(self.table, self)
+        if self._from_clause is None:
+            self._from_clause = self._walk_tables(self.table, self)
+        return self._from_clause
 
     def _walk_tables(self, current_from, ctx):
         foreign_keys = sorted(ctx.fk_columns.keys())
@@ -304,7 +968,22 @@ class QueryBuilderHelper(object):
         elem1 = self._walk(values, elem1)
         elem2 = self._walk(values, elem2)
         assert op in _operators.keys(), "Unsupported operator: %s" % op
+        if _untyped_bindparam(elem1) and isinstance(elem2, expr.ColumnElement) and \
+                not isinstance(elem2, expr.BindParameter):
+            # SqlAlchemy only gives the type of the column to a bind parameter on the right of an operator
+            elem1 = sql.bindparam(elem1.key, type_=elem2.type)
         return _operators[op](elem1, elem2)
 
 class _JoinPart(object):
     pass
+
+def _copy_fk_columns(fk_columns):
+    """
+        Copies a tree of ``_JoinPart``, keeping the same table aliases.
+    """
+    copy = {}
+    for name, part in fk_columns.items():
+        copy[name] = _JoinPart()
+        copy[name].table = part.table
+        copy[name].fk_columns = _copy_fk_columns(part.fk_columns)
+    return copy
@@ -25,12 +25,29 @@ import os.path
 import sqlalchemy as sa
 import sqlalchemy.sql as sql
 import sqlalchemy.sql.expression
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.mysql
+import sqlalchemy.dialects.sqlite
 import werkzeug.local
 import collections
 from . import expression as expr
 import re
 import datetime
-from .application import conn
+import decimal
+import json
+import base64
+import dateutil.parser
+import threading
+import time
+import sys
+import csv
+import weakref
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import pylru
+from .application import conn, app, _LazyConnection
 
 class PersistenceException(Exception):
     pass
@@ -43,10 +60,43 @@ class UnrecoverablePersistenceException(PersistenceException):
     """
     pass
 
+"""
+Maximum number of rows sent in a single multi-row insert statement.
+"""
+BULK_BATCH_SIZE = 1000
+
+"""
+Maximum number of bound parameters accepted by SQLite in a single statement.
+"""
+SQLITE_MAX_VARIABLES = 999
+
+"""
+Maximum number of statements kept in the statement cache of the table managers.
+"""
+STATEMENT_CACHE_SIZE = 500
+
 _order_regex = re.compile("^([a-zA-Z_][a-zA-Z_0-9]*(?:\.[a-zA-Z_][a-zA-Z_0-9]*)*)(?:\s+(asc|desc))?$")
 
+_metric_regex = re.compile("^(count|sum|avg|min|max)\s*\(\s*(\*|[a-zA-Z_][a-zA-Z_0-9]*(?:\.[a-zA-Z_][a-zA-Z_0-9]*)*)\s*\)$")
+
 class TableManager(object):
     table = None
+    """
+    If true, the records read using ``read_by_id()`` and ``read_many_by_id()`` are kept in an identity map bound
+    to the current transaction. Any call to ``update()`` or ``delete()`` empties it for the table.
+    """
+    use_identity_map = False
+    """
+    The maximum number of ids put in a single ``IN`` clause by the ``*_many_by_id()`` methods. Longer lists of ids
+    are processed using multiple queries.
+    """
+    id_chunk_size = 500
+    """
+    A ``ResultCache`` storing the results of ``read()`` and ``count()``, shared by all the transactions. It is
+    invalidated when records are created, updated or deleted using any manager of the table, once the transaction is
+    commited. Should only be used for tables that are rarely modified, and only through table managers.
+    """
+    result_cache = None
 
     @property
     def table(self):
@@ -56,14 +106,21 @@ class TableManager(object):
         """
             Converts any type of expression into a valid SqlAlchemy clause element which can be
             inserted into any query using the `where_clause()` method.
+
+            Variables are replaced by bind parameters, use ``expr.variable_params()`` to obtain their values.
+
+            When the expression does not use foreign keys, the clause applies directly on the table. Otherwise the
+            clause is ``id IN (subselect)``, the subselect containing the outer joins.
         """
         exp, values = _convert_expression(expression)
         if isinstance(exp, sqlalchemy.sql.expression.ClauseElement):
             return exp
         if exp is None:
             return sqlalchemy.sql.expression.literal(True)
-        qbh = expr.QueryBuilderHelper(self.table)
+        qbh = expr.QueryBuilderHelper(self.table, bind_variables=True)
         where_clause = qbh.where_clause(exp, values)
+        if len(qbh.fk_columns) == 0:
+            return where_clause
         subselect = sql.select([self.table.c.id]).select_from(qbh.from_clause())
         subselect = subselect.where(where_clause)
         return self.table.c.id.in_(subselect)
@@ -71,22 +128,126 @@ class TableManager(object):
     def create(self, values=None):
         return self.create_many([values])[0]
 
-    def create_many(self, values_list=None):
+    def create_many(self, values_list=None, bulk=False):
         """
         Create multiple records in the table using the given list of dictionaries.
+
+        If ``bulk`` is true, the dictionaries are grouped by column set and inserted using multi-row inserts
+        instead of one statement per record. The generated ids are still returned in the same order than the
+        dictionaries when the database can provide them (``RETURNING`` or sequential row ids on SQLite),
+        otherwise this method falls back to one insert per record.
         """
         assert isinstance(values_list, collections.Iterable), "Expected a list: %s" % values_list
-        ins = self.table.insert()
-        created = []
+        values_list = [val or {} for val in values_list]
         for val in values_list:
-            val = val or {}
             assert isinstance(val, dict), "Expected a dictionary: %s" % val
             if __debug__:
                 for k in val.keys():
                     assert hasattr(self.table.c, k), "Table %s doesn't contain a column named %s" % (self.table, k)
+        self._result_cache_invalidate()
+        if bulk:
+            return self._create_bulk(values_list)
+        ins = self.table.insert()
+        created = []
+        for val in values_list:
             created.append(conn.execute(ins.values(**val)).inserted_primary_key[0])
         return created
 
+    def _create_bulk(self, values_list):
+        # a null id is generated by the database, as with the other inserts
+        values_list = [dict([(k, v) for k, v in val.items() if k != "id"]) if "id" in val and val["id"] is None
+            else val for val in values_list]
+        groups = collections.OrderedDict()
+        for i, val in enumerate(values_list):
+            groups.setdefault(tuple(sorted(val.keys())), []).append(i)
+        created = [None] * len(values_list)
+        dialect = conn.dialect
+        ins = self.table.insert()
+        for keys, indexes in groups.items():
+            rows = [values_list[i] for i in indexes]
+            if "id" in keys:
+                # ids are given by the caller, no need to ask them to the database
+                conn.execute(ins, rows)
+                ids = [row["id"] for row in rows]
+            elif len(keys) == 0 or not dialect.supports_multivalues_insert:
+                ids = [conn.execute(ins.values(**row)).inserted_primary_key[0] for row in rows]
+            elif dialect.implicit_returning:
+                ids = []
+                for chunk in _chunks(rows, BULK_BATCH_SIZE):
+                    ids += [x[0] for x in conn.execute(ins.values(chunk).returning(self.table.c.id))]
+            elif dialect.name == "sqlite":
+                ids = []
+                # SQLite assigns consecutive row ids to the rows of a single insert statement
+                for chunk in _chunks(rows, max(1, min(BULK_BATCH_SIZE, SQLITE_MAX_VARIABLES // len(keys)))):
+                    last = conn.execute(ins.values(chunk)).lastrowid
+                    ids += range(last - len(chunk) + 1, last + 1)
+            else:
+                ids = [conn.execute(ins.values(**row)).inserted_primary_key[0] for row in rows]
+            for i, id in zip(indexes, ids):
+                created[i] = id
+        return created
+
+    def upsert(self, key, values):
+        self.upsert_many(key, [values])
+
+    def upsert_many(self, key, values_list):
+        """
+        Inserts multiple records using the given list of dictionaries. When a record with the same value in the
+        ``key`` column already exists, it is updated instead. ``key`` must be the name of a column having a unique
+        constraint and must be present in all dictionaries. The dictionaries are applied in order, so when a key
+        appears multiple times the last dictionary wins.
+
+        On PostgreSQL, MySQL and SQLite (with SqlAlchemy >= 1.4) the records are sent in batches using the native
+        upsert statement of the database. Please note that MySQL takes into account all the unique constraints of
+        the table, not only ``key``. On other databases each record is updated, then inserted if it did not exist,
+        which is not safe if another transaction inserts the same key concurrently.
+        """
+        assert hasattr(self.table.c, key), "Table %s doesn't contain a column named %s" % (self.table, key)
+        assert isinstance(values_list, collections.Iterable), "Expected a list: %s" % values_list
+        groups = []
+        for val in values_list:
+            assert isinstance(val, dict), "Expected a dictionary: %s" % val
+            assert key in val, "Expected a dictionary containing %s: %s" % (key, val)
+            if __debug__:
+                for k in val.keys():
+                    assert hasattr(self.table.c, k), "Table %s doesn't contain a column named %s" % (self.table, k)
+            keys = tuple(sorted(val.keys()))
+            # consecutive dictionaries with the same columns are sent together, to apply them in order
+            if len(groups) == 0 or groups[-1][0] != keys:
+                groups.append((keys, collections.OrderedDict()))
+            # a statement can not affect the same row twice, the last values win
+            groups[-1][1][val[key]] = val
+        self._identity_map_invalidate()
+        self._result_cache_invalidate()
+        dialect = conn.dialect
+        insert = _native_inserts.get(dialect.name)
+        for keys, rows in groups:
+            rows = list(rows.values())
+            others = [k for k in keys if k != key]
+            if insert is None:
+                for row in rows:
+                    clause = getattr(self.table.c, key) == row[key]
+                    if len(others) > 0:
+                        found = self.update(clause, dict([(k, row[k]) for k in others]))
+                    else:
+                        found = self.count(clause)
+                    if not found:
+                        self.create(row)
+                continue
+            batch_size = BULK_BATCH_SIZE
+            if dialect.name == "sqlite":
+                batch_size = max(1, min(batch_size, SQLITE_MAX_VARIABLES // len(keys)))
+            for chunk in _chunks(rows, batch_size):
+                query = insert(self.table).values(chunk)
+                if dialect.name == "mysql":
+                    query = query.on_duplicate_key_update(dict([(k, query.inserted[k]) for k in (others or [key])]))
+                elif len(others) > 0:
+                    query = query.on_conflict_do_update(index_elements=[key],
+                        set_=dict([(k, query.excluded[k]) for k in others]))
+                else:
+                    query = query.on_conflict_do_nothing(index_elements=[key])
+                conn.execute(query)
+
     def read_by_id(self, id, fields=None):
         """
         Returns a dictionary containing the asked fields for the current table where the record is identified by
@@ -106,8 +267,20 @@ class TableManager(object):
         this method will raise a ``PersistenceException``.
         """
         assert isinstance(ids, collections.Iterable), "Expected a list: %s" % ids
+        identity_map = self._identity_map()
+        if identity_map is not None and (fields is None or all(["." not in f for f in fields])):
+            missing = list(set([id for id in ids if id not in identity_map]))
+            for record in self._read_chunked(missing, None):
+                identity_map[record["id"]] = record
+            res = []
+            for id in ids:
+                if id not in identity_map:
+                    raise PersistenceException("Id %s was not found in table %s" % (id, self.table.name))
+                record = identity_map[id]
+                res.append(dict(record) if fields is None else dict([(f, record[f]) for f in fields]))
+            return res
         hasid = fields is None or "id" in fields
-        res = self.read(self.table.c.id.in_(ids), fields if hasid else fields + ["id"])
+        res = self._read_chunked(ids, fields if hasid else fields + ["id"])
         index = dict([(x["id"], x) for x in res])
         res = []
         for id in ids:
@@ -119,110 +292,1184 @@ class TableManager(object):
                 del el["id"]
         return res
 
-    def read(self, expression=None, fields=None, order=None, limit=None, offset=None):
+    def _read_chunked(self, ids, fields):
+        res = []
+        for chunk in _chunks(list(ids), self.id_chunk_size):
+            res += self.read(["id in :ids", {"ids": chunk}], fields)
+        return res
+
+    def _identity_map(self):
+        """
+            Returns the dictionary containing the records of the table cached in the current transaction, or
+            ``None`` if the identity map is not used.
+        """
+        if not self.use_identity_map:
+            return None
+        maps = getattr(conn, "identity_map", None)
+        if maps is None:
+            return None
+        return maps.setdefault(self.table, {})
+
+    def read(self, expression=None, fields=None, order=None, limit=None, offset=None, row_format="dict",
+            include=None):
+        """
+        Returns the records matching the given expression.
+
+        ``row_format`` defines the type of the returned records: ``"dict"`` returns dictionaries, ``"tuple"``
+        returns tuples containing the values of the fields in the asked order and ``"record"`` returns named tuples
+        (dots in field names are replaced by ``__``, names that can not be used as attributes, like the ones starting
+        with ``_`` or the repeated ones, are replaced by ``_`` followed by the position of the field). Tuples and
+        named tuples are faster to create and use less memory than dictionaries.
+
+        ``include`` is a dictionary of related records to attach to each returned dictionary. Keys are the names
+        under which related records are attached, values are relations, optionally given with the list of fields
+        to read as ``[relation, fields]``. A relation can be:
+
+        * The name of a foreign key of the table, the referenced record is attached (or ``None``).
+        * A ``table_name.column_name`` string designating a foreign key of another table referencing this one, the
+          list of referencing records is attached, ordered by id.
+
+        Each relation is loaded using one additional query, whatever the number of records.
+        """
+        if include:
+            assert row_format == "dict", "include can only be used with the dict row format"
+            return self._read_including(expression, fields, order, limit, offset, include)
+        return self._cached_result(("read", expression, fields, order, limit, offset, row_format),
+            lambda: self._read(expression, fields, order, limit, offset, row_format))
+
+    def _read(self, expression, fields, order, limit, offset, row_format):
+        query, params, cached, fields, selectable, _ = self._read_query(expression, fields, order, limit, offset)
+        # execution
+        res = _execute(query, params, cached)
+        # convertion
+        return _convert_rows(res, fields, selectable, row_format)
+
+    def _read_including(self, expression, fields, order, limit, offset, include):
+        relations = [(name,) + self._relation(spec) for name, spec in include.items()]
         if fields is None:
             fields = self.table.c.keys()
+        extra = []
+        for relation in relations:
+            if relation[1] not in fields and relation[1] not in extra:
+                extra.append(relation[1])
+        records = self.read(expression, list(fields) + extra, order, limit, offset)
+        for name, local, other_table, remote, other_fields, many in relations:
+            keys = list(set([r[local] for r in records if r[local] is not None]))
+            if other_fields is None:
+                other_fields = other_table.c.keys()
+            queried_fields = list(other_fields) + ([remote] if remote not in other_fields else [])
+            manager = _relation_manager(other_table)
+            related = []
+            for chunk in _chunks(keys, self.id_chunk_size):
+                related += manager.read(["%s in :ids" % remote, {"ids": chunk}], queried_fields, "id")
+            index = {}
+            for r in related:
+                key = r[remote]
+                if remote not in other_fields:
+                    del r[remote]
+                if many:
+                    index.setdefault(key, []).append(r)
+                else:
+                    index[key] = r
+            for r in records:
+                r[name] = index.get(r[local], [] if many else None)
+        for r in records:
+            for f in extra:
+                del r[f]
+        return records
+
+    def _relation(self, spec):
+        """
+            Parses a relation given to the ``include`` argument of ``read()``. Returns the column of this table to
+            match, the related table, the column of the related table to match, the fields to read and whether
+            multiple records can be related.
+        """
+        relation, fields = (spec, None) if isinstance(spec, (str, unicode)) else spec
+        if "." not in relation:
+            assert hasattr(self.table.c, relation), "Table %s doesn't contain a column named %s" % (self.table, relation)
+            col = getattr(self.table.c, relation)
+            assert len(col.foreign_keys) == 1, "Column %s must have exactly one foreign key" % col
+            other_column = list(col.foreign_keys)[0].column
+            assert other_column is other_column.table.c.id, "Column %s must reference an id column" % col
+            return relation, other_column.table, "id", fields, False
+        table_name, column_name = relation.rsplit(".", 1)
+        other_table = self.table.metadata.tables.get(table_name)
+        assert other_table is not None, "Unknown table: %s" % table_name
+        assert hasattr(other_table.c, column_name), "Table %s doesn't contain a column named %s" % (other_table, column_name)
+        col = getattr(other_table.c, column_name)
+        assert any([fk.column is self.table.c.id for fk in col.foreign_keys]), \
+            "Column %s does not reference the column id in table %s" % (col, self.table)
+        return "id", other_table, column_name, fields, True
+
+    def import_file(self, file, format="csv", batch_size=1000):
+        """
+        Creates records from the content of a file object, which can be in the ``"csv"`` format (the first line
+        containing the names of the columns) or in the ``"jsonl"`` format (one JSON object per line). Records are
+        created in bulk, ``batch_size`` at a time, so the file is never entirely loaded in memory.
+
+        Values are converted according to the type of their column: strings are parsed into integers, floats,
+        decimals, booleans, dates and datetimes. In CSV files, empty strings are considered as null values except
+        for string columns.
+
+        Returns a dictionary containing the number of imported ``rows``, the number of ``seconds`` it took and the
+        throughput in ``rows_per_second``.
+        """
+        assert format in ("csv", "jsonl"), "Unknown format: %s" % format
+        assert batch_size > 0, "batch_size must be a positive integer"
+        start = time.time()
+        if format == "csv":
+            reader = csv.reader(file)
+            header = [h.decode("utf8") for h in next(reader)]
+            rows = (dict(zip(header, [v.decode("utf8") for v in line])) for line in reader)
+        else:
+            rows = (json.loads(line) for line in file if line.strip())
+        converters = {}
+        count = 0
+        batch = []
+        for row in rows:
+            for k, v in row.items():
+                if k not in converters:
+                    assert hasattr(self.table.c, k), "Table %s doesn't contain a column named %s" % (self.table, k)
+                    converters[k] = _converter(getattr(self.table.c, k).type, format == "csv")
+                row[k] = converters[k](v)
+            batch.append(row)
+            if len(batch) >= batch_size:
+                count += len(self.create_many(batch, bulk=True))
+                batch = []
+        if len(batch) > 0:
+            count += len(self.create_many(batch, bulk=True))
+        return _transfer_stats(count, start)
+
+    def export_file(self, file, expression=None, fields=None, order=None, format="csv", chunk_size=1000):
+        """
+        Writes the records matching the given expression in a file object, in the ``"csv"`` format (the first line
+        containing the names of the fields) or in the ``"jsonl"`` format (one JSON object per line). Records are
+        streamed using ``read_iter()``. Dates and datetimes are written in the ISO 8601 format.
+
+        Returns a dictionary containing the number of exported ``rows``, the number of ``seconds`` it took and the
+        throughput in ``rows_per_second``.
+        """
+        assert format in ("csv", "jsonl"), "Unknown format: %s" % format
+        start = time.time()
+        if fields is None:
+            fields = self.table.c.keys()
+        records = self.read_iter(expression, fields, order, chunk_size=chunk_size, row_format="tuple")
+        count = 0
+        if format == "csv":
+            writer = csv.writer(file)
+            writer.writerow([f.encode("utf8") for f in fields])
+            for record in records:
+                writer.writerow([_csv_value(v) for v in record])
+                count += 1
+        else:
+            for record in records:
+                file.write(json.dumps(dict(zip(fields, record)), default=_json_value) + "\n")
+                count += 1
+        return _transfer_stats(count, start)
+
+    def scan(self, expression=None, fields=None, partitions=4, callback=None, chunk_size=1000, row_format="dict"):
+        """
+        Reads the records matching the given expression in parallel. The range of ids is split in ``partitions``
+        slices, each one being read in its own thread, using its own connection and transaction. The number of
+        threads is limited by the number of connections left in the pool of the engine, but is at least one.
+
+        If ``callback`` is ``None``, returns a generator yielding the records as they arrive, in no particular
+        order. Otherwise ``callback`` is called in the reading threads with lists of at most ``chunk_size``
+        records and this method returns the number of records once all slices are processed.
+
+        As the slices are read in other transactions, the modifications of the current transaction are not visible.
+        In-memory SQLite databases are not supported, as each thread would see a different database.
+
+        When the generator is closed or the callback raises an exception, the reading threads stop at the next
+        record.
+        """
+        assert partitions > 0, "partitions must be a positive integer"
+        application = app._get_current_object()
+        url = application.engine.url
+        assert not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")), \
+            "scan() can not be used with an in-memory SQLite database"
         exp, values = _convert_expression(expression)
+        res = _execute(sql.select([sql.func.min(self.table.c.id), sql.func.max(self.table.c.id)])
+            .where(self._expression(expression)), expr.variable_params(values), False).fetchone()
+        slices = queue.Queue()
+        if res[0] is not None:
+            step = (res[1] - res[0]) // partitions + 1
+            for i in range(partitions):
+                slices.put((res[0] + i * step, res[0] + (i + 1) * step))
+        pool = application.engine.pool
+        if isinstance(pool, sqlalchemy.pool.QueuePool):
+            # the connection of the current transaction, and those of the other ones, are not available
+            workers = min(partitions, max(1, pool.size() - pool.checkedout()))
+        else:
+            workers = partitions
+        workers = max(1, min(workers, slices.qsize()))
+        messages = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        errors = []
 
-        qbh = expr.QueryBuilderHelper(self.table)
-        # list of fields
-        selectable = [qbh.column(k) for k in fields]
-        # where clause
-        where_clause = qbh.where_clause(exp, values)
-        # orders
+        def read_slice(start, end):
+            bounds = {"__scan_start": start, "__scan_end": end}
+            if isinstance(exp, sqlalchemy.sql.expression.ClauseElement):
+                return self.read_iter(sql.and_(exp, self.table.c.id >= start, self.table.c.id < end), fields,
+                    chunk_size=chunk_size, row_format=row_format)
+            where = "id >= :__scan_start and id < :__scan_end"
+            where = "(%s) and %s" % (exp, where) if exp is not None else where
+            return self.read_iter([where, dict(values, **bounds)], fields, chunk_size=chunk_size,
+                row_format=row_format)
+
+        def send(message):
+            while not stop.is_set():
+                try:
+                    messages.put(message, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def process(chunk):
+            if stop.is_set():
+                return
+            if callback is None:
+                send(("records", chunk))
+            else:
+                callback(chunk)
+                send(("records", len(chunk)))
+
+        def work():
+            try:
+                with application:
+                    while not stop.is_set():
+                        try:
+                            start, end = slices.get_nowait()
+                        except queue.Empty:
+                            break
+                        with application.transaction():
+                            records = read_slice(start, end)
+                            try:
+                                chunk = []
+                                for record in records:
+                                    if stop.is_set():
+                                        break
+                                    chunk.append(record)
+                                    if len(chunk) >= chunk_size:
+                                        process(chunk)
+                                        chunk = []
+                                if len(chunk) > 0:
+                                    process(chunk)
+                            finally:
+                                records.close()
+            except Exception:
+                # with the traceback, lost when raising the exception in another thread
+                errors.append(sys.exc_info())
+                stop.set()
+            finally:
+                send(("done", None))
+
+        def run():
+            threads = [threading.Thread(target=work) for i in range(workers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            try:
+                done = 0
+                while done < workers:
+                    if len(errors) > 0:
+                        _reraise(errors[0])
+                    try:
+                        kind, value = messages.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if kind == "done":
+                        done += 1
+                    else:
+                        yield value
+                if len(errors) > 0:
+                    _reraise(errors[0])
+            finally:
+                stop.set()
+                for thread in threads:
+                    thread.join()
+
+        if callback is None:
+            return (record for chunk in run() for record in chunk)
+        return sum(run())
+
+    def read_iter(self, expression=None, fields=None, order=None, limit=None, offset=None, chunk_size=1000,
+            row_format="dict"):
+        """
+        Same as ``read()`` but returns a generator. The records are fetched using a server-side cursor when the
+        database supports it, ``chunk_size`` records at a time, so the whole result is never loaded in memory.
+
+        The generator must be consumed inside the transaction that created it.
+        """
+        assert chunk_size > 0, "chunk_size must be a positive integer"
+        query, params, cached, fields, selectable, _ = self._read_query(expression, fields, order, limit, offset)
+        res = _execute(query, params, cached, stream_results=True)
+        try:
+            while True:
+                chunk = res.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                for record in _convert_rows(chunk, fields, selectable, row_format):
+                    yield record
+        finally:
+            res.close()
+
+    def read_columns(self, expression=None, fields=None, order=None, limit=None, offset=None, chunk_size=10000):
+        """
+        Returns the matching records as an ordered dictionary containing one NumPy masked array per field. Null
+        values are masked. The type of the arrays depends on the type of the columns: integers, floats, booleans
+        and dates use native NumPy types, other columns use arrays of objects.
+
+        The arrays are allocated before reading the records, which are fetched ``chunk_size`` at a time. This
+        method needs NumPy to be installed.
+        """
+        import numpy
+        assert chunk_size > 0, "chunk_size must be a positive integer"
+        size = self.count(expression)
+        if offset:
+            size = max(0, size - offset)
+        if limit:
+            size = min(size, limit)
+        query, params, cached, fields, selectable, _ = self._read_query(expression, fields, order, limit, offset)
+        dtypes = [_numpy_type(s.type) for s in selectable]
+        arrays = [numpy.empty(size, dtype=dtype) for dtype in dtypes]
+        masks = [numpy.zeros(size, dtype=bool) for dtype in dtypes]
+        n = 0
+        res = _execute(query, params, cached, stream_results=True)
+        try:
+            while True:
+                chunk = res.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                if n + len(chunk) > size:
+                    # records were added since the count
+                    size = n + len(chunk)
+                    arrays = [numpy.resize(a, size) for a in arrays]
+                    masks = [numpy.resize(m, size) for m in masks]
+                columns = list(zip(*_convert_rows(chunk, fields, selectable, "tuple")))
+                for i in range(len(fields)):
+                    mask = [v is None for v in columns[i]]
+                    fill = _numpy_fills[dtypes[i]]
+                    arrays[i][n:n + len(chunk)] = [fill if v is None else v for v in columns[i]]
+                    masks[i][n:n + len(chunk)] = mask
+                n += len(chunk)
+        finally:
+            res.close()
+        return collections.OrderedDict([(fields[i], numpy.ma.MaskedArray(arrays[i][:n], masks[i][:n]))
+            for i in range(len(fields))])
+
+    def read_page(self, expression=None, fields=None, order=None, limit=None, cursor=None, row_format="dict"):
+        """
+        Reads a page of records using keyset pagination. Returns a list containing the records and the cursor
+        to give to the next call to obtain the following page, or ``None`` if there is no following page.
+
+        Contrary to the ``offset`` argument of ``read()``, the cost of fetching a page does not depend on its
+        position. ``order`` must only contain string order specifiers; the ``id`` column is automatically added
+        as last order to make it total. Ordered columns should not contain null values and must contain strings,
+        numbers, booleans, dates, times or decimals, other types raise a ``PersistenceException``. So does a cursor
+        that was not returned by a previous call with the same order.
+        """
         order = order or []
-        order = order if not isinstance(order, (sqlalchemy.sql.expression.ClauseElement, str, unicode)) else [order]
-        order_bys = []
+        order = list(order) if not isinstance(order, (str, unicode)) else [order]
         for o in order:
-            if isinstance(o, (str, unicode)):
-                match = _order_regex.match(o)
-                assert match is not None, "Not a valid order specifier: %s" % o
-                o = qbh.column(match.group(1))
-                o = o.asc() if match.group(2) != "desc" else o.desc()
-            order_bys.append(o)
-        # query
-        query = sql.select(selectable)
-        query = query.select_from(qbh.from_clause())
-        if where_clause is not None:
-            query = query.where(where_clause)
-        for o in order_bys:
-            query = query.order_by(o)
-        # limit & offeset
+            assert isinstance(o, (str, unicode)), "Only string order specifiers are supported: %s" % o
+        if "id" not in [_order_regex.match(o).group(1) for o in order if _order_regex.match(o) is not None]:
+            order.append("id")
+        # validated before using the statement cache, which may contain a query built for another cursor
+        seek = _decode_cursor(cursor, len(order)) if cursor is not None else None
+        query, params, cached, fields, selectable, keys = self._read_query(expression, fields, order, limit, None,
+            paged=True, seek=seek)
+        res = _execute(query, params, cached).fetchall()
+        lst = _convert_rows(res, fields, selectable, row_format)
+        next_cursor = None
+        if limit and len(res) == limit:
+            next_cursor = _encode_cursor([res[-1][col] for col, desc in keys])
+        return [lst, next_cursor]
+
+    def _read_query(self, expression, fields, order, limit, offset, paged=False, seek=None, with_count=False):
+        """
+            Builds the select query used by the ``read()`` methods. Returns the query, the parameters to execute it
+            with, whether the query comes from the statement cache, the list of fields, the list of corresponding
+            selected columns and the list of ``(column, descending)`` pairs of the string order specifiers.
+
+            If ``paged`` is true, the ordered columns are also selected. If ``seek`` is given, it must contain one
+            value per order specifier and only the records located after those values in the order will be
+            selected. If ``with_count`` is true, the total number of matching records is selected in a column
+            named ``__total_count``.
+        """
+        if fields is None:
+            fields = self.table.c.keys()
+        exp, values = _convert_expression(expression)
+        order = order or []
+        order = order if not isinstance(order, (sqlalchemy.sql.expression.ClauseElement, str, unicode)) else [order]
+        key = None
+        if all([isinstance(o, (str, unicode)) for o in order]):
+            key = self._statement_key("read", exp, values, tuple(fields), tuple(order), bool(limit), bool(offset),
+                paged, seek is not None, with_count)
+
+        def build():
+            qbh = expr.QueryBuilderHelper(self.table, bind_variables=True)
+            # where clause, first to use the clause cache of the helper
+            where_clause = qbh.where_clause(exp, values)
+            # list of fields
+            selectable = [qbh.column(k) for k in fields]
+            # orders
+            order_bys = []
+            keys = []
+            for o in order:
+                if isinstance(o, (str, unicode)):
+                    match = _order_regex.match(o)
+                    assert match is not None, "Not a valid order specifier: %s" % o
+                    col = qbh.column(match.group(1))
+                    keys.append((col, match.group(2) == "desc"))
+                    o = col.asc() if match.group(2) != "desc" else col.desc()
+                order_bys.append(o)
+            # query
+            query = sql.select(selectable)
+            if paged:
+                for col, desc in keys:
+                    if not any([col is s for s in selectable]):
+                        query = query.column(col)
+            if with_count:
+                query = query.column(sql.func.count().over().label("__total_count"))
+            query = query.select_from(qbh.from_clause())
+            if where_clause is not None:
+                query = query.where(where_clause)
+            if seek is not None:
+                query = query.where(_seek_clause(keys))
+            for o in order_bys:
+                query = query.order_by(o)
+            # limit & offeset
+            if limit:
+                query = query.limit(sql.bindparam("__limit", type_=sa.Integer))
+            if offset:
+                query = query.offset(sql.bindparam("__offset", type_=sa.Integer))
+            return query, selectable, keys
+
+        query, selectable, keys = self._statement(key, build)
+        params = expr.variable_params(values)
         if limit:
-            query = query.limit(limit)
+            params["__limit"] = limit
         if offset:
-            query = query.offset(offset)
-        # execution
-        res = conn.execute(query)
-        # convertion to dict
-        lst = []
-        for el in res:
-            dct = {}
-            for i in range(len(fields)):
-                dct[fields[i]] = el[selectable[i]]
-            lst.append(dct)
-        return lst
+            params["__offset"] = offset
+        for i in range(len(seek or [])):
+            params["__seek_%d" % i] = seek[i]
+        return query, params, key is not None, fields, selectable, keys
+
+    def _statement_key(self, kind, exp, values, *args):
+        """
+            Returns the key used to store a statement in the statement cache, or ``None`` if the statement can not
+            be cached.
+        """
+        if isinstance(exp, sqlalchemy.sql.expression.ClauseElement):
+            return None
+        signature = expr.variables_signature(values)
+        if signature is None:
+            return None
+        return (kind, self.table, exp, signature) + args
+
+    def _statement(self, key, build):
+        """
+            Returns the statement stored in the statement cache under the given key. If there is none, it is created
+            using the ``build`` function.
+        """
+        if key is None:
+            return build()
+        statement = statement_cache.get(key)
+        if statement is None:
+            statement = build()
+            statement_cache[key] = statement
+        return statement
 
     def count(self, expression=None):
+        return self._cached_result(("count", expression), lambda: self._count(expression))
+
+    def _count(self, expression):
         exp, values = _convert_expression(expression)
-        qbh = expr.QueryBuilderHelper(self.table)
-        where_clause = qbh.where_clause(exp, values)
-        query = sql.select([sql.func.count(self.table.c.id)])
-        if where_clause is not None:
-            query = query.where(where_clause)
-        res = conn.execute(query).fetchone()[0]
+
+        def build():
+            qbh = expr.QueryBuilderHelper(self.table, bind_variables=True)
+            where_clause = qbh.where_clause(exp, values)
+            query = sql.select([sql.func.count(self.table.c.id)])
+            query = query.select_from(qbh.from_clause())
+            if where_clause is not None:
+                query = query.where(where_clause)
+            return query
+
+        key = self._statement_key("count", exp, values)
+        res = _execute(self._statement(key, build), expr.variable_params(values), key is not None).fetchone()[0]
         return res
 
-    def read_and_count(self, expression=None, fields=None, order=None, limit=None, offset=None):
-        count = self.count(expression)
-        res = self.read(expression, fields, order, limit, offset)
-        return [res, count]
+    def aggregate(self, expression=None, group_by=None, metrics=None, having=None, order=None, limit=None,
+            row_format="dict"):
+        """
+        Groups the records matching the given expression and computes metrics on each group in the database.
+
+        ``group_by`` is a list of field names, which can go through foreign keys like the fields of ``read()``.
+        ``metrics`` is a dictionary associating names to metric specifiers like ``"sum(amount)"``, ``"count(*)"``
+        or ``"max(partner.credit)"``. The supported functions are ``count``, ``sum``, ``avg``, ``min`` and
+        ``max``. ``having`` is a SAQL expression filtering the groups, it can use the names of the metrics and the
+        variables of ``expression``. ``order`` works like in ``read()`` and also accepts the names of the metrics.
+
+        Returns one record per group containing the grouped fields followed by the metrics, in the format defined
+        by ``row_format`` (see ``read()``). When ``metrics`` is not an ordered dictionary, metrics are sorted by name.
+        """
+        group_by = list(group_by or [])
+        metrics = metrics or {}
+        names = list(metrics.keys()) if isinstance(metrics, collections.OrderedDict) else sorted(metrics.keys())
+        exp, values = _convert_expression(expression)
+        order = order or []
+        order = [order] if isinstance(order, (str, unicode)) else list(order)
+        assert having is None or isinstance(having, (str, unicode)), "Expected a SAQL expression: %s" % having
+
+        def build():
+            qbh = _AggregateQueryBuilderHelper(self.table)
+            # the where clause, the grouped fields and the operands of the metrics only see the columns
+            where_clause = qbh.where_clause(exp, values)
+            selectable = [qbh.column(k) for k in group_by]
+            labels = []
+            for name in names:
+                match = _metric_regex.match(metrics[name])
+                assert match is not None, "Not a valid metric specifier: %s" % metrics[name]
+                function = getattr(sql.func, match.group(1))
+                if match.group(2) == "*":
+                    assert match.group(1) == "count", "Only count() accepts *: %s" % metrics[name]
+                    metric = function()
+                else:
+                    metric = function(qbh.column(match.group(2)))
+                labels.append(metric.label(name))
+            for name, label in zip(names, labels):
+                qbh.metrics[name] = label
+                selectable.append(label)
+            having_clause = qbh.where_clause(having, values)
+            order_bys = []
+            for o in order:
+                assert isinstance(o, (str, unicode)), "Only string order specifiers are supported: %s" % o
+                match = _order_regex.match(o)
+                assert match is not None, "Not a valid order specifier: %s" % o
+                col = qbh.column(match.group(1))
+                order_bys.append(col.asc() if match.group(2) != "desc" else col.desc())
+            query = sql.select(selectable)
+            query = query.select_from(qbh.from_clause())
+            if where_clause is not None:
+                query = query.where(where_clause)
+            for col in selectable[:len(group_by)]:
+                query = query.group_by(col)
+            if having_clause is not None:
+                query = query.having(having_clause)
+            for o in order_bys:
+                query = query.order_by(o)
+            if limit:
+                query = query.limit(sql.bindparam("__limit", type_=sa.Integer))
+            return query, selectable
+
+        key = self._statement_key("aggregate", exp, values, tuple(group_by),
+            tuple([(name, metrics[name]) for name in names]), having, tuple(order), bool(limit))
+        query, selectable = self._statement(key, build)
+        params = expr.variable_params(values)
+        if limit:
+            params["__limit"] = limit
+        res = _execute(query, params, key is not None)
+        return _convert_rows(res, group_by + names, selectable, row_format)
+
+    def read_and_count(self, expression=None, fields=None, order=None, limit=None, offset=None, row_format="dict"):
+        """
+        Returns a list containing the result of ``read()`` and the result of ``count()`` for the same expression.
+
+        When the database supports window functions, both are obtained with a single query.
+        """
+        if not _supports_window_functions(conn.dialect):
+            count = self.count(expression)
+            res = self.read(expression, fields, order, limit, offset, row_format)
+            return [res, count]
+        query, params, cached, fields, selectable, _ = self._read_query(expression, fields, order, limit, offset,
+            with_count=True)
+        res = _execute(query, params, cached).fetchall()
+        if len(res) > 0:
+            count = res[0]["__total_count"]
+        elif offset:
+            # the offset is past the last record, the window function can't tell us anything
+            count = self.count(expression)
+        else:
+            count = 0
+        return [_convert_rows(res, fields, selectable, row_format), count]
 
     def update_by_id(self, id, values):
         self.update_many_by_id([id], values)
 
     def update_many_by_id(self, ids, values):
         assert isinstance(ids, collections.Iterable), "Expected a list: %s" % ids
-        rowcount = self.update(self.table.c.id.in_(ids), values)
+        rowcount = 0
+        for chunk in _chunks(list(ids), self.id_chunk_size):
+            rowcount += self.update(["id in :ids", {"ids": chunk}], values)
         if rowcount != len(ids):
             raise UnrecoverablePersistenceException("One or more ids where not found while updating table %s", self.table.name)
 
+    def update_rows(self, rows):
+        """
+        Updates multiple records using a different dictionary of values for each one. Each dictionary must
+        contain the ``id`` of the record to update.
+
+        Rows updating the same columns are grouped and updated using a single statement executed with multiple sets
+        of parameters. If one id is not found in the table this method will raise a
+        ``UnrecoverablePersistenceException``.
+        """
+        assert isinstance(rows, collections.Iterable), "Expected a list: %s" % rows
+        groups = collections.OrderedDict()
+        for row in rows:
+            assert isinstance(row, dict), "Expected a dictionary: %s" % row
+            assert row.get("id") is not None, "Expected a dictionary containing an id: %s" % row
+            assert len(row) > 1, "Expected a dictionary containing values to update: %s" % row
+            if __debug__:
+                for k in row.keys():
+                    assert hasattr(self.table.c, k), "Table %s doesn't contain a column named %s" % (self.table, k)
+            groups.setdefault(tuple(sorted([k for k in row.keys() if k != "id"])), []).append(row)
+        self._identity_map_invalidate()
+        self._result_cache_invalidate()
+        rowcount = 0
+        count = 0
+        for keys, group in groups.items():
+            def build():
+                query = self.table.update()
+                query = query.where(self.table.c.id == sql.bindparam("__id", type_=self.table.c.id.type))
+                query = query.values(dict([(k, sql.bindparam("__set_" + k, type_=getattr(self.table.c, k).type))
+                    for k in keys]))
+                return query
+
+            query = self._statement(("update_rows", self.table, keys), build)
+            params = [dict([("__set_" + k, row[k]) for k in keys] + [("__id", row["id"])]) for row in group]
+            count += len(params)
+            if conn.dialect.supports_sane_multi_rowcount:
+                rowcount += _execute(query, params, True).rowcount
+            else:
+                for param in params:
+                    rowcount += _execute(query, param, True).rowcount
+        if rowcount != count:
+            raise UnrecoverablePersistenceException("One or more ids where not found while updating table %s", self.table.name)
+
     def update(self, expression=None, values=None):
         values = values or {}
         assert isinstance(values, dict), "Expected a dictionary: %s" % values
         if __debug__:
             for k in values.keys():
                 assert hasattr(self.table.c, k), "Table %s doesn't contain a column named %s" % (self.table, k)
-        query = self.table.update()
-        query = query.where(self._expression(expression))
-        query = query.values(values)
-        rowcount = conn.execute(query).rowcount
+        exp, variables = _convert_expression(expression)
+        key = None
+        if not any([isinstance(v, sqlalchemy.sql.expression.ClauseElement) for v in values.values()]):
+            key = self._statement_key("update", exp, variables, tuple(sorted(values.keys())))
+
+        def build():
+            query = self.table.update()
+            query = query.where(self._expression(expression))
+            query = query.values(dict([(k, v if isinstance(v, sqlalchemy.sql.expression.ClauseElement) else
+                sql.bindparam("__set_" + k, type_=getattr(self.table.c, k).type)) for k, v in values.items()]))
+            return query
+
+        self._identity_map_invalidate()
+        self._result_cache_invalidate()
+        params = expr.variable_params(variables)
+        for k, v in values.items():
+            params["__set_" + k] = v
+        rowcount = _execute(self._statement(key, build), params, key is not None).rowcount
         return rowcount
 
+    def _cached_result(self, args, compute):
+        """
+            Returns the result stored in the result cache for the given arguments. If there is none, it is computed
+            using the ``compute`` function and stored.
+        """
+        if self.result_cache is None:
+            return compute()
+        _register_result_cache(self.table, self.result_cache)
+        written = _result_cache_writes()
+        if written is not None and self.table in written:
+            # the cache doesn't know about the modifications of the current transaction
+            return compute()
+        try:
+            key = (self.table, _freeze(args))
+            hash(key)
+        except TypeError:
+            return compute()
+        found, result = self.result_cache.get(key)
+        if not found:
+            version = self.result_cache.version(self.table)
+            result = compute()
+            # a replica may lag behind the primary database, its results are not shared
+            if not getattr(conn, "readonly", False):
+                self.result_cache.set(key, result, version)
+        # the callers may modify what they receive
+        if isinstance(result, list):
+            return [dict(x) if isinstance(x, dict) else x for x in result]
+        return result
+
+    def _result_cache_invalidate(self):
+        # the results may have been cached by another manager of the same table
+        table = self.table
+        written = _result_cache_writes()
+        if written is None:
+            _invalidate_result_caches(table)
+        elif table not in written:
+            written.add(table)
+            conn.on_commit.append(lambda: _invalidate_result_caches(table))
+
+    def _identity_map_invalidate(self):
+        # the records may have been cached by another manager of the same table
+        maps = getattr(conn, "identity_map", None)
+        if maps is not None and self.table in maps:
+            maps[self.table].clear()
+
     def delete_by_id(self, id):
         self.delete_many_by_id([id])
 
     def delete_many_by_id(self, ids):
         assert isinstance(ids, collections.Iterable), "Expected a list: %s" % ids
-        rowcount = self.delete(self.table.c.id.in_(ids))
+        rowcount = 0
+        for chunk in _chunks(list(ids), self.id_chunk_size):
+            rowcount += self.delete(["id in :ids", {"ids": chunk}])
         if rowcount != len(ids):
             raise UnrecoverablePersistenceException("One or more ids where not found while deleting rows in table %s", self.table.name)
 
     def delete(self, expression=None):
-        query = self.table.delete()
-        query = query.where(self._expression(expression))
-        rowcount = conn.execute(query).rowcount
+        exp, values = _convert_expression(expression)
+
+        def build():
+            query = self.table.delete()
+            query = query.where(self._expression(expression))
+            return query
+
+        self._identity_map_invalidate()
+        self._result_cache_invalidate()
+        key = self._statement_key("delete", exp, values)
+        rowcount = _execute(self._statement(key, build), expr.variable_params(values), key is not None).rowcount
         return rowcount
 
+class _AggregateQueryBuilderHelper(expr.QueryBuilderHelper):
+    """
+    A ``QueryBuilderHelper`` resolving the names of the metrics of an aggregation, for the having clause and the
+    order specifiers.
+    """
+    cache_clauses = False
+
+    def __init__(self, table):
+        super(_AggregateQueryBuilderHelper, self).__init__(table, bind_variables=True)
+        self.metrics = {}
+
+    def column(self, val):
+        if val in self.metrics:
+            return self.metrics[val]
+        return super(_AggregateQueryBuilderHelper, self).column(val)
+
+class ResultCache(object):
+    """
+    A thread-safe LRU cache for the results of the table managers. Entries expire after ``ttl`` seconds and the
+    least recently used entries are evicted when the cache contains more than ``size`` entries or when the
+    estimated memory used by the results exceeds ``max_memory`` bytes.
+    """
+    def __init__(self, size=1000, ttl=60, max_memory=64 * 1024 * 1024):
+        self.size = size
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._versions = {}
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Returns a tuple containing a boolean indicating if the key was found and the stored value.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.memory -= entry[1]
+                self.misses += 1
+                return False, None
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[2]
+
+    def version(self, table):
+        """
+        Returns a number incremented each time the given table is invalidated.
+        """
+        with self._lock:
+            return self._versions.get(table, 0)
+
+    def set(self, key, value, version):
+        """
+        Stores a value computed for a table of the given version. Nothing is stored if the table was invalidated
+        in the mean time.
+        """
+        memory = _estimate_memory(value)
+        if memory > self.max_memory:
+            return
+        with self._lock:
+            if self._versions.get(key[0], 0) != version:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.memory -= old[1]
+            self._entries[key] = (time.time() + self.ttl, memory, value)
+            self.memory += memory
+            while len(self._entries) > self.size or self.memory > self.max_memory:
+                self.memory -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def invalidate(self, table):
+        """
+        Removes all the entries concerning the given table.
+        """
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            for key in [k for k in self._entries.keys() if k[0] is table]:
+                self.memory -= self._entries.pop(key)[1]
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "memory": self.memory,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / total if total > 0 else 0.,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+def _estimate_memory(value):
+    memory = sys.getsizeof(value)
+    if isinstance(value, dict):
+        memory += sum([sys.getsizeof(v) for v in value.values()])
+    elif isinstance(value, (list, tuple)):
+        memory += sum([_estimate_memory(v) for v in value])
+    return memory
+
+def _freeze(value):
+    """
+    Converts the arguments of a read into a hashable value. Raises a ``TypeError`` for arguments that can not be
+    compared by value.
+    """
+    if isinstance(value, sqlalchemy.sql.expression.ClauseElement):
+        raise TypeError("SqlAlchemy clauses can not be cached")
+    elif isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    elif isinstance(value, dict):
+        return tuple(sorted([(k, _freeze(v)) for k, v in value.items()]))
+    return value
+
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+def _register_result_cache(table, cache):
+    """
+    Records that ``cache`` contains results of ``table``, for the writes of all the managers of the table to
+    invalidate it.
+    """
+    with _result_caches_lock:
+        caches = _result_caches.get(table)
+        if caches is None:
+            caches = weakref.WeakSet()
+            _result_caches[table] = caches
+        caches.add(cache)
+
+def _invalidate_result_caches(table):
+    with _result_caches_lock:
+        caches = list(_result_caches.get(table, []))
+    for cache in caches:
+        cache.invalidate(table)
+
+def _result_cache_writes():
+    """
+    Returns the set of tables modified in the current transaction, or ``None`` if the current connection was not
+    opened by ``Asgard.transaction()``.
+    """
+    # the attributes of the connection are not probed, it would be opened by the lookup of a missing one
+    current = app._conn_stack.top
+    if not isinstance(current, _LazyConnection):
+        return None
+    return current.result_cache_writes
+
+class StatementCache(object):
+    """
+    A thread-safe LRU cache counting its hits and misses. It is used to store the statements built by the table
+    managers and their compiled forms.
+    """
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._cache = pylru.lrucache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def __len__(self):
+        return len(self._cache)
+
+    def resize(self, size):
+        with self._lock:
+            self._cache.size(size)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"size": len(self._cache), "max_size": self._cache.size(), "hits": self.hits, "misses": self.misses}
+
+"""
+The cache containing the statements built by the table managers.
+"""
+statement_cache = StatementCache(STATEMENT_CACHE_SIZE)
+
+"""
+The cache containing the compiled form of the statements stored in ``statement_cache``.
+"""
+compiled_cache = StatementCache(STATEMENT_CACHE_SIZE)
+
+def _execute(query, params, cached, **options):
+    """
+    Executes a statement in the current connection. The compiled form of the statement is kept in ``compiled_cache``
+    if it comes from the statement cache.
+    """
+    if cached:
+        options["compiled_cache"] = compiled_cache
+    return (conn.execution_options(**options) if options else conn).execute(query, params)
+
+_native_inserts = {
+    "postgresql": sqlalchemy.dialects.postgresql.insert,
+    "mysql": sqlalchemy.dialects.mysql.insert,
+}
+if hasattr(sqlalchemy.dialects.sqlite, "insert"):
+    _native_inserts["sqlite"] = sqlalchemy.dialects.sqlite.insert
+
 def _convert_expression(expression):
+    """
+    Returns the expression and its variables. SAQL expressions are normalized, for expressions differing only by
+    their literals to share their statements.
+    """
     if isinstance(expression, sqlalchemy.sql.expression.ClauseElement):
         return expression, {}
     if isinstance(expression, (str, unicode, type(None))):
-        return expression, {}
+        return expr.normalize(expression, {})
     else:
         assert isinstance(expression, collections.Iterable), "Expected a list: %s" % expression
         assert len(expression) == 2, "Expected a list of 2 elements: %s" % expression
-        return expression
+        return expr.normalize(expression[0], expression[1])
+
+def _convert_rows(rows, fields, selectable, row_format):
+    """
+    Converts result rows to the given row format. The fields are the first selected columns, unless the same column
+    was selected twice, in which case SqlAlchemy only selects it once.
+    """
+    assert row_format in ("dict", "tuple", "record"), "Unknown row format: %s" % row_format
+    size = len(fields)
+    aligned = len(set([id(s) for s in selectable])) == size
+    if row_format == "dict":
+        if aligned:
+            return [dict(zip(fields, el)) for el in rows]
+        return [dict([(fields[i], el[selectable[i]]) for i in range(size)]) for el in rows]
+    if not aligned:
+        rows = [[el[s] for s in selectable] for el in rows]
+    if row_format == "tuple":
+        return [tuple(el[:size]) for el in rows]
+    record_class = _record_class(tuple(fields))
+    return [record_class._make(el[:size]) for el in rows]
+
+_record_classes = pylru.lrucache(200)
+_record_classes_lock = threading.Lock()
+
+def _record_class(fields):
+    with _record_classes_lock:
+        try:
+            return _record_classes[fields]
+        except KeyError:
+            pass
+    # invalid or repeated names are replaced by their position, like _1
+    record_class = collections.namedtuple(str("Record"), [str(f.replace(".", "__")) for f in fields], rename=True)
+    with _record_classes_lock:
+        _record_classes[fields] = record_class
+    return record_class
+
+def _converter(type_, from_csv):
+    """
+    Returns a function converting the values read from a file into values for a column of the given type.
+    """
+    if isinstance(type_, sa.Boolean):
+        convert = lambda v: v.lower() in ("1", "true", "t", "yes", "y")
+    elif isinstance(type_, sa.Integer):
+        convert = int
+    elif isinstance(type_, sa.Float) or (isinstance(type_, sa.Numeric) and not type_.asdecimal):
+        convert = float
+    elif isinstance(type_, sa.Numeric):
+        convert = decimal.Decimal
+    elif isinstance(type_, sa.DateTime):
+        convert = dateutil.parser.parse
+    elif isinstance(type_, sa.Date):
+        convert = lambda v: dateutil.parser.parse(v).date()
+    else:
+        return lambda v: v
+    def converter(value):
+        if not isinstance(value, (str, unicode)):
+            return value
+        if from_csv and value == "":
+            return None
+        return convert(value)
+    return converter
+
+def _csv_value(value):
+    if value is None:
+        return b""
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    elif isinstance(value, unicode):
+        return value.encode("utf8")
+    return value
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        return unicode(value)
+    raise TypeError("%r is not JSON serializable" % value)
+
+def _transfer_stats(count, start):
+    seconds = time.time() - start
+    return {"rows": count, "seconds": seconds, "rows_per_second": count / seconds if seconds > 0 else 0.}
+
+_relation_managers = {}
+
+def _relation_manager(table):
+    if table not in _relation_managers:
+        _relation_managers[table] = table_manager(table)()
+    return _relation_managers[table]
+
+_numpy_fills = {
+    "bool": False,
+    "int64": 0,
+    "float64": 0.,
+    "datetime64[us]": None,
+    "datetime64[D]": None,
+    "object": None,
+}
+
+def _numpy_type(type_):
+    if isinstance(type_, sa.Boolean):
+        return "bool"
+    elif isinstance(type_, sa.Integer):
+        return "int64"
+    elif isinstance(type_, sa.Numeric):
+        return "float64"
+    elif isinstance(type_, sa.DateTime):
+        return "datetime64[us]"
+    elif isinstance(type_, sa.Date):
+        return "datetime64[D]"
+    return "object"
+
+def _supports_window_functions(dialect):
+    if dialect.name == "postgresql":
+        return True
+    elif dialect.name == "sqlite":
+        return dialect.dbapi.sqlite_version_info >= (3, 25)
+    elif dialect.name == "mysql":
+        version = dialect.server_version_info or ()
+        return version >= ((10, 2) if dialect._is_mariadb else (8, 0))
+    return False
+
+def _seek_clause(keys):
+    """
+    Creates a clause selecting the rows located strictly after the values of the ``__seek_<n>`` parameters in the
+    order defined by ``keys``, a list of ``(column, descending)`` pairs.
+    """
+    values = [sql.bindparam("__seek_%d" % i) for i in range(len(keys))]
+    clauses = []
+    for i in range(len(keys)):
+        col, desc = keys[i]
+        parts = [keys[j][0] == values[j] for j in range(i)]
+        parts.append(col < values[i] if desc else col > values[i])
+        clauses.append(sql.and_(*parts))
+    return sql.or_(*clauses)
+
+def _encode_cursor(values):
+    lst = []
+    for val in values:
+        if isinstance(val, datetime.datetime):
+            val = {"datetime": val.isoformat()}
+        elif isinstance(val, datetime.date):
+            val = {"date": val.isoformat()}
+        elif isinstance(val, datetime.time):
+            val = {"time": val.isoformat()}
+        elif isinstance(val, decimal.Decimal):
+            val = {"decimal": unicode(val)}
+        elif not isinstance(val, (str, unicode, int, long, float, bool, type(None))):
+            raise PersistenceException("Values of type %s can not be used to order pages" % type(val).__name__)
+        lst.append(val)
+    return base64.urlsafe_b64encode(json.dumps(lst).encode("utf8")).decode("ascii")
+
+def _decode_cursor(cursor, size):
+    """
+    Returns the values contained in a cursor created by ``_encode_cursor()``. Raises a ``PersistenceException`` if
+    it does not contain ``size`` scalar values.
+    """
+    try:
+        lst = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8"))
+    except (ValueError, TypeError, UnicodeError):
+        raise PersistenceException("Invalid cursor: %s" % cursor)
+    if not isinstance(lst, list) or len(lst) != size:
+        raise PersistenceException("Invalid cursor: %s" % cursor)
+    values = []
+    for val in lst:
+        try:
+            if isinstance(val, dict) and len(val) == 1 and "datetime" in val:
+                val = dateutil.parser.parse(val["datetime"])
+            elif isinstance(val, dict) and len(val) == 1 and "date" in val:
+                val = dateutil.parser.parse(val["date"]).date()
+            elif isinstance(val, dict) and len(val) == 1 and "time" in val:
+                val = dateutil.parser.parse(val["time"]).timetz()
+            elif isinstance(val, dict) and len(val) == 1 and "decimal" in val:
+                val = decimal.Decimal(val["decimal"])
+        except (ValueError, TypeError, AttributeError, OverflowError, decimal.InvalidOperation):
+            raise PersistenceException("Invalid cursor: %s" % cursor)
+        if not isinstance(val, (unicode, int, long, float, bool, type(None), datetime.date, datetime.time,
+                decimal.Decimal)):
+            raise PersistenceException("Invalid cursor: %s" % cursor)
+        values.append(val)
+    return values
+
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec("def _reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n")
+
+def _chunks(lst, size):
+    for i in range(0, len(lst), size):
+        yield lst[i:i + size]
 
 def table_manager(table):
     """
@@ -74,6 +74,19 @@ class ExpressionsParserTest(unittest.TestCase):
         result = expression._parser.parseString("[1, 2]")[0]
         self.assertEqual(result, ("list", [("literal", 1), ("literal", 2)]))
 
+    def test_normalize(self):
+        result = expression.normalize("b == 2 and a * (1 + 2) > -1 and c in ['x', 'y']", {"v": 1})
+        self.assertEqual(result, ("(((b == :__literal_0) and ((a * :__literal_1) > :__literal_2)) and "
+            "(c in :__literal_3))", {"v": 1, "__literal_0": 2, "__literal_1": 3, "__literal_2": -1,
+            "__literal_3": ["x", "y"]}))
+        self.assertEqual(expression.normalize("c in ['z'] and (a * 5 > 1 and b == 4)")[0], result[0])
+        self.assertEqual(expression.normalize("1 == 2"), ("(1 == 2)", None))
+        self.assertEqual(expression.normalize("x in [1, y]")[0], "(x in [:__literal_0, y])")
+        self.assertEqual(expression.normalize('not (status in ["married", "single"])'),
+            ("(not (status in :__literal_0))", {"__literal_0": ["married", "single"]}))
+        self.assertEqual(expression.normalize("a == 1 and b == :__literal_0", {"__literal_0": 5}),
+            ("a == 1 and b == :__literal_0", {"__literal_0": 5}))
+
     def _test_op2(self, op):
         result = expression._parser.parseString("1 %s 2" % op)[0]
         self.assertEqual(result, ("op2", op, ("literal", 1), ("literal", 2)))
@@ -239,6 +252,19 @@ class ExpressionEvaluatorTest(unittest.TestCase):
         alias_table2 = test_table2.alias()
         query = test_table3.outerjoin(alias_table2)
         self.assertEqual(str(result), str(query))
+
+    def test_clause_cache(self):
+        qbh = expression.QueryBuilderHelper(test_table3, bind_variables=True)
+        result = qbh.where_clause("table2.key == :key and id > 3", {"key": "a"})
+        from_clause = qbh.from_clause()
+        qbh2 = expression.QueryBuilderHelper(test_table3, bind_variables=True)
+        self.assertIs(qbh2.where_clause("table2.key == :key and id > 3", {"key": "b"}), result)
+        self.assertIs(qbh2.from_clause(), from_clause)
+        self.assertEqual(expression.variable_params({"key": "b"}), {"saql_key": "b"})
+        qbh3 = expression.QueryBuilderHelper(test_table3, bind_variables=True)
+        self.assertIsNot(qbh3.where_clause("table2.key == :key and id > 3", {"key": None}), result)
+        qbh3 = expression.QueryBuilderHelper(test_table3)
+        self.assertIsNot(qbh3.where_clause("table2.key == :key and id > 3", {"key": "b"}), result)
     
     """
     # only to test performances
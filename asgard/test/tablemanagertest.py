@@ -22,6 +22,14 @@
 from __future__ import unicode_literals, print_function, absolute_import
 
 import unittest
+import tempfile
+import shutil
+import os
+import sys
+import traceback
+import contextlib
+import datetime
+import decimal
 
 import asgard.tables as table_manager
 import sqlalchemy as sa
@@ -57,6 +65,45 @@ class TestTableManager(table_manager.table_manager(test_table)):
 
 TestTableManager.i = TestTableManager()
 
+test_child_table = sa.Table('test_child_table', app.metadata,
+   sa.Column('id', sa.Integer, primary_key=True),
+   sa.Column('name', sa.String(50)),
+   sa.Column('parent_id', sa.Integer, sa.ForeignKey('test_table.id')),
+)
+
+class TestChildTableManager(table_manager.table_manager(test_child_table)):
+    pass
+
+TestChildTableManager.i = TestChildTableManager()
+
+class UpperString(sa.types.TypeDecorator):
+    impl = sa.String
+
+    def process_bind_param(self, value, dialect):
+        return value.upper() if value is not None else None
+
+test_coded_table = sa.Table('test_coded_table', app.metadata,
+   sa.Column('id', sa.Integer, primary_key=True),
+   sa.Column('code', UpperString(50)),
+)
+
+class TestCodedTableManager(table_manager.table_manager(test_coded_table)):
+    pass
+
+TestCodedTableManager.i = TestCodedTableManager()
+
+test_typed_table = sa.Table('test_typed_table', app.metadata,
+   sa.Column('id', sa.Integer, primary_key=True),
+   sa.Column('moment', sa.Time),
+   sa.Column('amount', sa.Numeric(10, 2)),
+   sa.Column('data', sa.PickleType),
+)
+
+class TestTypedTableManager(table_manager.table_manager(test_typed_table)):
+    pass
+
+TestTypedTableManager.i = TestTypedTableManager()
+
 class TableManagerTest(DbTest):
 
     def test_create(self):
@@ -105,6 +152,17 @@ class TableManagerTest(DbTest):
         self.assertEqual(records[0]["key"], "c")
         self.assertEqual(records[1]["key"], "d")
 
+    def test_read_count_foreign_key(self):
+        parents = TestTableManager.i.create_many([{"key": "x"}, {"key": "y"}])
+        TestChildTableManager.i.create_many([{"name": "n%d" % i, "parent_id": parents[i % 2]} for i in range(6)])
+        records, count = TestChildTableManager.i.read_and_count("parent_id.key == 'x'", ["name"], "name", 2, 1)
+        self.assertEqual([x["name"] for x in records], ["n2", "n4"])
+        self.assertEqual(count, 3)
+        records, count = TestChildTableManager.i.read_and_count("parent_id.key == 'x'", ["name"], "name", 2, 10)
+        self.assertEqual(records, [])
+        self.assertEqual(count, 3)
+        self.assertEqual(TestChildTableManager.i.count("parent_id.key == 'x'"), 3)
+
     def test_read_id(self):
         id = TestTableManager.i.create({"key": "a", "value": "b"})
         record = TestTableManager.i.read_by_id(id, ["id", "key"])
@@ -174,3 +232,598 @@ class TableManagerTest(DbTest):
         self.assertEqual(records[0]["key"], "pacman")
         records = TestTableManager.i.read('key like ("%" + value + "%")')
         self.assertEqual(len(records), 3)
+
+    def test_create_bulk(self):
+        ids = TestTableManager.i.create_many([
+            {"key": "a", "value": "b"},
+            {"key": "c"},
+            {"key": "d", "value": "e"},
+            {"id": 42, "key": "f"},
+        ], bulk=True)
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(ids[3], 42)
+        records = TestTableManager.i.read_many_by_id(ids)
+        self.assertEqual([x["key"] for x in records], ["a", "c", "d", "f"])
+        self.assertEqual([x["value"] for x in records], ["b", None, "e", None])
+        ids = TestTableManager.i.create_many([{"key": "k%d" % i} for i in range(1200)], bulk=True)
+        self.assertEqual([x["key"] for x in TestTableManager.i.read_many_by_id(ids)], ["k%d" % i for i in range(1200)])
+        ids = TestTableManager.i.create_many([{"id": None, "key": "g"}, {"id": None, "key": "h", "value": "i"}],
+            bulk=True)
+        self.assertTrue(None not in ids)
+        self.assertEqual([x["key"] for x in TestTableManager.i.read_many_by_id(ids)], ["g", "h"])
+
+    def test_read_iter(self):
+        TestTableManager.i.create_many([{"key": "k%02d" % i, "value": "b" if i % 2 else "c"} for i in range(25)])
+        records = TestTableManager.i.read_iter("value == 'b'", ["key"], "key desc", chunk_size=4)
+        self.assertFalse(isinstance(records, list))
+        self.assertEqual(list(records), [{"key": "k%02d" % i} for i in range(23, 0, -2)])
+
+    def test_read_page(self):
+        parents = TestTableManager.i.create_many([{"key": "b"}, {"key": "a"}])
+        TestChildTableManager.i.create_many([{"name": "n%d" % i, "parent_id": parents[i % 2]} for i in range(7)])
+        pages = []
+        cursor = None
+        while True:
+            records, cursor = TestChildTableManager.i.read_page(None, ["name"], ["parent_id.key desc", "name"], 2, cursor)
+            pages.append([x["name"] for x in records])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [["n0", "n2"], ["n4", "n6"], ["n1", "n3"], ["n5"]])
+        records, cursor = TestChildTableManager.i.read_page("name != 'n5'", ["name"], None, 3)
+        records, cursor = TestChildTableManager.i.read_page("name != 'n5'", ["name"], None, 3, cursor)
+        self.assertEqual([x["name"] for x in records], ["n3", "n4", "n6"])
+        with self.assertRaises(table_manager.PersistenceException):
+            TestChildTableManager.i.read_page(None, None, None, 3, "garbage")
+        for values in [[1, 2, 3], [[1]], [{"id": 1}]]:
+            with self.assertRaises(table_manager.PersistenceException):
+                TestChildTableManager.i.read_page("name != 'n5'", ["name"], None, 3,
+                    table_manager._encode_cursor(values))
+
+    def test_read_page_types(self):
+        TestTypedTableManager.i.create_many([{"moment": datetime.time(10 - i, 30), "amount": decimal.Decimal(i) / 4,
+            "data": [i]} for i in range(5)])
+        for order, field in [("moment", "moment"), ("amount desc", "amount")]:
+            values = []
+            cursor = None
+            while True:
+                records, cursor = TestTypedTableManager.i.read_page(None, [field], order, 2, cursor)
+                values += [x[field] for x in records]
+                if cursor is None:
+                    break
+            self.assertEqual(values, sorted(values, reverse=order.endswith("desc")))
+            self.assertEqual(len(values), 5)
+        with self.assertRaises(table_manager.PersistenceException):
+            TestTypedTableManager.i.read_page(None, ["id"], "data", 2)
+
+    def test_read_count_past_end(self):
+        TestTableManager.i.create_many([{"key": "a"}, {"key": "c"}, {"key": "d"}])
+        records, count = TestTableManager.i.read_and_count("key != 'a'", ["key"], "key asc", 2, 5)
+        self.assertEqual(records, [])
+        self.assertEqual(count, 2)
+        records, count = TestTableManager.i.read_and_count("key == 'x'")
+        self.assertEqual(records, [])
+        self.assertEqual(count, 0)
+
+    def test_statement_cache(self):
+        TestTableManager.i.create_many([{"key": "a", "value": "b"}, {"key": "c", "value": "d"}])
+        table_manager.statement_cache.clear()
+        self.assertEqual(TestTableManager.i.read(["key == :key", {"key": "a"}], ["value"]), [{"value": "b"}])
+        self.assertEqual(TestTableManager.i.read(["key == :key", {"key": "c"}], ["value"]), [{"value": "d"}])
+        self.assertEqual(TestTableManager.i.read(["key == :key", {"key": None}], ["value"]), [])
+        self.assertEqual(TestTableManager.i.read(["key in :keys", {"keys": ["a", "c"]}], ["value"], "key", 1, 1),
+            [{"value": "d"}])
+        self.assertEqual(TestTableManager.i.read(["key in :keys", {"keys": ["c"]}], ["value"], "key", 1, 2), [])
+        self.assertEqual(table_manager.statement_cache.stats()["hits"], 2)
+        self.assertEqual(table_manager.statement_cache.stats()["misses"], 3)
+        self.assertEqual(TestTableManager.i.update(["key == :key", {"key": "a"}], {"value": "x"}), 1)
+        self.assertEqual(TestTableManager.i.update(["key == :key", {"key": "c"}], {"value": "y"}), 1)
+        self.assertEqual(TestTableManager.i.count(["value == :v", {"v": "x"}]), 1)
+        self.assertEqual(TestTableManager.i.count(["value == :v", {"v": "y"}]), 1)
+        self.assertEqual(TestTableManager.i.delete(["value == :v", {"v": "x"}]), 1)
+        self.assertEqual(TestTableManager.i.delete(["value == :v", {"v": "y"}]), 1)
+        self.assertEqual(table_manager.statement_cache.stats()["hits"], 5)
+
+    def test_normalized_statements(self):
+        TestTableManager.i.create_many([{"key": "a", "value": "b"}, {"key": "c", "value": "d"}])
+        table_manager.statement_cache.clear()
+        self.assertEqual(TestTableManager.i.read("key == 'a' and value != 'x'", ["value"]), [{"value": "b"}])
+        self.assertEqual(TestTableManager.i.read("value != 'y' and key == 'c'", ["value"]), [{"value": "d"}])
+        self.assertEqual(TestTableManager.i.read("key in ['a', 'c']", ["value"], "key"),
+            [{"value": "b"}, {"value": "d"}])
+        self.assertEqual(TestTableManager.i.read("key in ['c']", ["value"], "key"), [{"value": "d"}])
+        self.assertEqual(TestTableManager.i.count("id > 1 + 1"), 0)
+        self.assertEqual(table_manager.statement_cache.stats()["hits"], 2)
+        self.assertEqual(table_manager.statement_cache.stats()["misses"], 3)
+
+    def test_identity_map(self):
+        class CachedTableManager(table_manager.table_manager(test_table)):
+            use_identity_map = True
+        manager = CachedTableManager()
+        id, id2 = manager.create_many([{"key": "a", "value": "b"}, {"key": "c", "value": "d"}])
+        self.assertEqual(manager.read_by_id(id, ["value"]), {"value": "b"})
+        application.conn.execute(test_table.update().values(value="x"))
+        self.assertEqual(manager.read_many_by_id([id2, id], ["key", "value"]), [{"key": "c", "value": "x"},
+            {"key": "a", "value": "b"}])
+        manager.update_by_id(id2, {"value": "y"})
+        self.assertEqual([x["value"] for x in manager.read_many_by_id([id, id2])], ["x", "y"])
+        manager.delete_by_id(id)
+        with self.assertRaises(table_manager.PersistenceException):
+            manager.read_by_id(id)
+        TestTableManager.i.update_by_id(id2, {"value": "z"})
+        self.assertEqual(manager.read_by_id(id2, ["value"]), {"value": "z"})
+        TestTableManager.i.delete_by_id(id2)
+        with self.assertRaises(table_manager.PersistenceException):
+            manager.read_by_id(id2)
+
+    def test_many_by_id_chunks(self):
+        class ChunkedTableManager(table_manager.table_manager(test_table)):
+            id_chunk_size = 3
+        manager = ChunkedTableManager()
+        ids = manager.create_many([{"key": "k%d" % i, "value": "a"} for i in range(10)], bulk=True)
+        self.assertEqual([x["key"] for x in manager.read_many_by_id(ids[::-1], ["key"])], ["k%d" % i for i in range(9, -1, -1)])
+        manager.update_many_by_id(ids[2:], {"value": "b"})
+        self.assertEqual(manager.count("value == 'b'"), 8)
+        with self.assertRaises(table_manager.UnrecoverablePersistenceException):
+            manager.update_many_by_id(ids + [69], {"value": "c"})
+        manager.delete_many_by_id(ids[:7])
+        self.assertEqual(manager.count(), 3)
+        with self.assertRaises(table_manager.UnrecoverablePersistenceException):
+            manager.delete_many_by_id(ids)
+
+    def test_update_rows(self):
+        ids = TestTableManager.i.create_many([{"key": "k%d" % i, "value": "a"} for i in range(4)])
+        TestTableManager.i.update_rows([
+            {"id": ids[0], "value": "x"},
+            {"id": ids[1], "key": "y", "value": "z"},
+            {"id": ids[2], "value": "w"},
+        ])
+        records = TestTableManager.i.read_many_by_id(ids, ["key", "value"])
+        self.assertEqual(records, [{"key": "k0", "value": "x"}, {"key": "y", "value": "z"},
+            {"key": "k2", "value": "w"}, {"key": "k3", "value": "a"}])
+        with self.assertRaises(table_manager.UnrecoverablePersistenceException):
+            TestTableManager.i.update_rows([{"id": ids[3], "value": "v"}, {"id": 69, "value": "v"}])
+
+    def test_upsert(self):
+        id = TestTableManager.i.create({"key": "a", "value": "b"})
+        TestTableManager.i.upsert("key", {"key": "a", "value": "c"})
+        TestTableManager.i.upsert_many("key", [
+            {"key": "d", "value": "e"},
+            {"key": "a", "value": "f"},
+            {"key": "d", "value": "g"},
+            {"key": "h"},
+        ])
+        records = TestTableManager.i.read(None, ["key", "value"], "key")
+        self.assertEqual(records, [{"key": "a", "value": "f"}, {"key": "d", "value": "g"}, {"key": "h", "value": None}])
+        self.assertEqual(TestTableManager.i.read_by_id(id)["value"], "f")
+        TestTableManager.i.upsert_many("key", [
+            {"key": "m", "value": "x"},
+            {"key": "m", "value": "y", "id": 50},
+            {"key": "m", "value": "z"},
+        ])
+        self.assertEqual(TestTableManager.i.read("key == 'm'", ["id", "value"]), [{"id": 50, "value": "z"}])
+
+    def test_update_delete_joins(self):
+        parents = TestTableManager.i.create_many([{"key": "a", "value": "x"}, {"key": "b", "value": "y"}])
+        TestChildTableManager.i.create_many([{"name": "n1", "parent_id": parents[0]},
+            {"name": "n2", "parent_id": parents[1]}, {"name": "n3"}])
+        self.assertEqual(TestChildTableManager.i.update("name == 'n3' or parent_id.value == 'y'", {"name": "m"}), 2)
+        self.assertEqual(TestChildTableManager.i.update("name == 'n1'", {"name": "o"}), 1)
+        self.assertEqual([x["name"] for x in TestChildTableManager.i.read(None, ["name"], "id")], ["o", "m", "m"])
+        self.assertEqual(TestChildTableManager.i.delete("parent_id.key == 'a'"), 1)
+        self.assertEqual(TestChildTableManager.i.delete("name == 'm'"), 2)
+        self.assertEqual(TestChildTableManager.i.count(), 0)
+
+    def test_row_format(self):
+        parent = TestTableManager.i.create({"key": "a", "value": "b"})
+        TestChildTableManager.i.create({"name": "n", "parent_id": parent})
+        records = TestChildTableManager.i.read(None, ["name", "parent_id.key", "name"], row_format="tuple")
+        self.assertEqual(records, [("n", "a", "n")])
+        records = TestChildTableManager.i.read(None, ["parent_id.value", "name"], row_format="record")
+        self.assertEqual(records[0].parent_id__value, "b")
+        self.assertEqual(records[0].name, "n")
+        records = TestChildTableManager.i.read(None, ["name", "parent_id.key", "name"], row_format="record")
+        self.assertEqual(records, [("n", "a", "n")])
+        self.assertEqual(records[0]._fields, ("name", "parent_id__key", "_2"))
+        self.assertEqual(table_manager._record_class(("_rank", "id"))._fields, ("_0", "id"))
+        records, count = TestTableManager.i.read_and_count(None, ["key"], row_format="tuple")
+        self.assertEqual(records, [("a",)])
+
+    def test_read_columns(self):
+        import numpy
+        parent = TestTableManager.i.create({"key": "a", "value": "b"})
+        TestChildTableManager.i.create_many([{"name": "n%d" % i, "parent_id": parent if i % 2 else None}
+            for i in range(5)])
+        columns = TestChildTableManager.i.read_columns("name != 'n0'", ["parent_id", "parent_id.key", "name"],
+            "name", chunk_size=2)
+        self.assertEqual(list(columns.keys()), ["parent_id", "parent_id.key", "name"])
+        self.assertEqual(columns["parent_id"].dtype, numpy.int64)
+        self.assertEqual(columns["parent_id"].tolist(), [parent, None, parent, None])
+        self.assertEqual(columns["parent_id.key"].tolist(), ["a", None, "a", None])
+        self.assertEqual(columns["name"].tolist(), ["n1", "n2", "n3", "n4"])
+
+    def test_aggregate(self):
+        parents = TestTableManager.i.create_many([{"key": "a", "value": "x"}, {"key": "b", "value": "y"}])
+        TestChildTableManager.i.create_many([{"name": "n%d" % i, "parent_id": parents[i % 2]} for i in range(5)])
+        records = TestChildTableManager.i.aggregate(None, ["parent_id.key"],
+            {"total": "count(*)", "last": "max(name)"}, order="total desc")
+        self.assertEqual(records, [{"parent_id.key": "a", "total": 3, "last": "n4"},
+            {"parent_id.key": "b", "total": 2, "last": "n3"}])
+        records = TestChildTableManager.i.aggregate(["name != :name", {"name": "n0", "min": 2}], ["parent_id"],
+            {"total": "count(id)"}, having="total >= :min", order="parent_id", row_format="tuple")
+        self.assertEqual(records, [(parents[0], 2), (parents[1], 2)])
+        records = TestChildTableManager.i.aggregate(None, [], {"total": "sum(parent_id)"}, row_format="tuple")
+        self.assertEqual(records, [(parents[0] * 3 + parents[1] * 2,)])
+
+    def test_aggregate_metric_named_like_column(self):
+        parents = TestTableManager.i.create_many([{"key": "a", "value": "x"}, {"key": "b", "value": "y"}])
+        ids = TestChildTableManager.i.create_many([{"name": "n%d" % i, "parent_id": parents[i % 2]}
+            for i in range(4)])
+        records = TestChildTableManager.i.aggregate(["parent_id == :p", {"p": parents[1]}], [],
+            {"parent_id": "sum(parent_id)"}, having="parent_id > 0", row_format="tuple")
+        self.assertEqual(records, [(parents[1] * 2,)])
+        records = TestChildTableManager.i.aggregate(None, [], {"id": "count(id)", "total": "sum(id)"},
+            order="id", row_format="tuple")
+        self.assertEqual(records, [(4, sum(ids))])
+
+    def test_read_include(self):
+        parents = TestTableManager.i.create_many([{"key": "a", "value": "x"}, {"key": "b", "value": "y"}])
+        TestChildTableManager.i.create_many([{"name": "n%d" % i, "parent_id": parents[0]} for i in range(3)] +
+            [{"name": "o"}])
+        records = TestTableManager.i.read(None, ["key"], "key", include={
+            "children": ["test_child_table.parent_id", ["name"]],
+        })
+        self.assertEqual(records, [{"key": "a", "children": [{"name": "n0"}, {"name": "n1"}, {"name": "n2"}]},
+            {"key": "b", "children": []}])
+        records = TestChildTableManager.i.read(None, ["name"], "name", include={"parent": ["parent_id", ["key"]]})
+        self.assertEqual(records, [{"name": "n0", "parent": {"key": "a"}}, {"name": "n1", "parent": {"key": "a"}},
+            {"name": "n2", "parent": {"key": "a"}}, {"name": "o", "parent": None}])
+
+    def test_result_cache(self):
+        class CachedTableManager(table_manager.table_manager(test_table)):
+            result_cache = table_manager.ResultCache(size=10, ttl=60)
+        manager = CachedTableManager()
+        id = manager.create({"key": "a", "value": "b"})
+        self.assertEqual(manager.read(None, ["value"]), [{"value": "b"}])
+        self.trans.__exit__(None, None, None)
+        try:
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"]), [{"value": "b"}])
+                application.conn.execute(test_table.update().values(value="x"))
+                self.assertEqual(manager.read(None, ["value"]), [{"value": "b"}])
+                manager.create({"key": "c", "value": "d"})
+                self.assertEqual(manager.count(), 2)
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"], "key"), [{"value": "x"}, {"value": "d"}])
+                self.assertEqual(manager.count(), 2)
+                self.assertEqual(manager.count(), 2)
+        finally:
+            self.trans = app.transaction()
+            self.trans.__enter__()
+        stats = CachedTableManager.result_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["invalidations"]), (2, 3, 2))
+
+    def test_result_cache_lazy_connection(self):
+        class CachedTableManager(table_manager.table_manager(test_table)):
+            result_cache = table_manager.ResultCache(size=10, ttl=60)
+        manager = CachedTableManager()
+        manager.create({"key": "a", "value": "b"})
+        self.trans.__exit__(None, None, None)
+        try:
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"]), [{"value": "b"}])
+            checkouts = app._engine_pool_stats(app.engine).stats()["checkouts"]
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"]), [{"value": "b"}])
+                self.assertFalse(application.conn.connected)
+            self.assertEqual(app._engine_pool_stats(app.engine).stats()["checkouts"], checkouts)
+            self.assertEqual(CachedTableManager.result_cache.stats()["hits"], 1)
+        finally:
+            self.trans = app.transaction()
+            self.trans.__enter__()
+
+    def test_result_cache_other_manager(self):
+        class CachedTableManager(table_manager.table_manager(test_table)):
+            result_cache = table_manager.ResultCache(size=10, ttl=60)
+        manager = CachedTableManager()
+        manager.create({"key": "a", "value": "a"})
+        self.trans.__exit__(None, None, None)
+        try:
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"]), [{"value": "a"}])
+            with app.transaction():
+                TestTableManager.i.create({"key": "b", "value": "b"})
+                self.assertEqual(manager.read(None, ["value"], "key"), [{"value": "a"}, {"value": "b"}])
+                self.assertEqual(manager.count(), 2)
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"], "key"), [{"value": "a"}, {"value": "b"}])
+                TestTableManager.i.delete("key == 'b'")
+            with app.transaction():
+                self.assertEqual(manager.read(None, ["value"], "key"), [{"value": "a"}])
+        finally:
+            self.trans = app.transaction()
+            self.trans.__enter__()
+
+    def test_import_export(self):
+        import io
+        stats = TestTableManager.i.import_file(io.BytesIO(b"key,value\na,b\nc,\n\xc3\xa9,d\n"), batch_size=2)
+        self.assertEqual(stats["rows"], 3)
+        records = TestTableManager.i.read(None, ["key", "value"], "id")
+        self.assertEqual(records, [{"key": "a", "value": "b"}, {"key": "c", "value": ""}, {"key": "\xe9", "value": "d"}])
+        TestChildTableManager.i.import_file(io.StringIO('{"name": "n", "parent_id": "1"}\n\n{"name": "o"}\n'),
+            format="jsonl")
+        out = io.BytesIO()
+        stats = TestChildTableManager.i.export_file(out, None, ["name", "parent_id"], "name")
+        self.assertEqual(stats["rows"], 2)
+        self.assertEqual(out.getvalue(), b"name,parent_id\r\nn,1\r\no,\r\n")
+        out = io.StringIO()
+        TestTableManager.i.export_file(out, "key != 'c'", ["key"], "key", format="jsonl")
+        self.assertEqual(out.getvalue(), '{"key": "a"}\n{"key": "\\u00e9"}\n')
+
+    @contextlib.contextmanager
+    def file_database(self, **options):
+        """Replaces the in-memory database by a temporary file, outside of the transaction of the test."""
+        self.trans.__exit__(None, None, None)
+        memory_engine = app.engine
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            app.engine = sa.create_engine('sqlite:///' + path, **options)
+            app.metadata.create_all(app.engine)
+            yield
+        finally:
+            app.engine.dispose()
+            os.remove(path)
+            app.engine = memory_engine
+            self.trans = app.transaction()
+            self.trans.__enter__()
+
+    def test_scan(self):
+        with self.file_database():
+            with app.transaction():
+                TestTableManager.i.create_many([{"key": "k%d" % i, "value": "a" if i % 3 else "b"}
+                    for i in range(100)], bulk=True)
+            with app.transaction():
+                records = TestTableManager.i.scan("value == 'a'", ["key"], 7, chunk_size=5)
+                self.assertEqual(sorted([x["key"] for x in records]),
+                    sorted(["k%d" % i for i in range(100) if i % 3]))
+                chunks = []
+                count = TestTableManager.i.scan(None, ["id"], 3, chunks.append, 10, "tuple")
+                self.assertEqual(count, 100)
+                self.assertEqual(sorted([x[0] for c in chunks for x in c]), list(range(1, 101)))
+                self.assertEqual(list(TestTableManager.i.scan("value == 'c'")), [])
+
+    def test_scan_pool(self):
+        with self.file_database(poolclass=sa.pool.QueuePool, pool_size=2, max_overflow=0, pool_timeout=1):
+            with app.transaction():
+                TestTableManager.i.create_many([{"key": "k%d" % i} for i in range(20)], bulk=True)
+            with app.transaction():
+                self.assertEqual(len(list(TestTableManager.i.scan(None, ["key"], 4, chunk_size=3))), 20)
+
+    def test_scan_stop(self):
+        read = []
+        class CountingTableManager(table_manager.table_manager(test_table)):
+            def read_iter(self, *args, **kwargs):
+                for record in super(CountingTableManager, self).read_iter(*args, **kwargs):
+                    read.append(record)
+                    yield record
+        manager = CountingTableManager()
+        self.assertRaises(AssertionError, lambda: manager.scan())
+        with self.file_database():
+            with app.transaction():
+                manager.create_many([{"key": "k%d" % i} for i in range(1000)], bulk=True)
+            with app.transaction():
+                records = manager.scan(None, ["key"], 2, chunk_size=1)
+                next(records)
+                records.close()
+                self.assertTrue(len(read) < 100)
+                calls = []
+                def callback(chunk):
+                    calls.append(chunk)
+                    raise ValueError("callback error")
+                try:
+                    manager.scan(None, ["key"], 4, callback, 1)
+                    self.fail("callback error not raised")
+                except ValueError:
+                    frames = traceback.extract_tb(sys.exc_info()[2])
+                self.assertEqual(frames[-1][2], "callback")
+                self.assertTrue(len(calls) < 50)
+
+    def test_lazy_connection(self):
+        self.assertFalse(application.conn.connected)
+        self.assertEqual(TestTableManager.i.count(), 0)
+        self.assertTrue(application.conn.connected)
+
+    def test_pool_stats(self):
+        pool_app = application.Asgard(__name__)
+        pool_app.configure({"database": {"sqlalchemy.url": "sqlite://", "pool_warmup": 1, "pool_pre_ping": True}})
+        stats = pool_app.pool_stats()
+        self.assertEqual(stats["replicas"], [])
+        self.assertEqual(stats["primary"]["checked_out"], 0)
+        self.assertEqual(stats["primary"]["checkouts"], 1)
+        with pool_app.transaction():
+            pool_app.conn.execute("select 1")
+            self.assertEqual(pool_app.pool_stats()["primary"]["checked_out"], 1)
+        stats = pool_app.pool_stats()["primary"]
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["timeouts"], 0)
+        self.assertEqual(sum(count for bound, count in stats["wait_histogram"]), 1)
+        queue_engine = sa.create_engine("sqlite://", poolclass=sa.pool.QueuePool, pool_size=1, max_overflow=2)
+        pool_app.engine = queue_engine
+        self.assertEqual(pool_app.pool_stats()["primary"]["overflow"], -1)
+        queue_engine.dispose()
+        connections = [pool_app._connect(False) for i in range(2)]
+        self.assertEqual(pool_app.pool_stats()["primary"]["overflow"], 1)
+        for connection in connections:
+            connection.close()
+
+    def test_pool_sqlalchemy_options(self):
+        pool_app = application.Asgard(__name__)
+        pool_app.configure({"database": {"sqlalchemy.url": "sqlite://", "sqlalchemy.pool_recycle": "3600",
+            "sqlalchemy.pool_pre_ping": "true"}})
+        self.assertEqual(pool_app.engine.pool._recycle, 3600)
+        self.assertTrue(pool_app.engine.pool._pre_ping)
+        pool_app.configure({"database": {"sqlalchemy.url": "sqlite://", "sqlalchemy.pool_recycle": "3600",
+            "pool_recycle": 60}})
+        self.assertEqual(pool_app.engine.pool._recycle, 60)
+        self.assertFalse(pool_app.engine.pool._pre_ping)
+
+    def test_expression_cache(self):
+        app_stats = app.expression_cache.stats()
+        cache_app = application.Asgard(__name__)
+        cache_app.configure({"expressions": {"cache_size": 2}})
+        self.assertEqual(cache_app.expression_cache.stats()["max_size"], 2)
+        with cache_app:
+            for exp in ["id == 1", "id == 2", "id == 1", "id == 3"]:
+                table_manager.expr.QueryBuilderHelper(test_table).where_clause(exp)
+        stats = cache_app.expression_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 3, 1))
+        self.assertTrue(stats["parse_time"] > 0)
+        self.assertEqual(app.expression_cache.stats(), app_stats)
+
+    def test_persistent_expression_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            config = {"expressions": {"persistent_cache": os.path.join(directory, "saql.sqlite")}}
+            first_app = application.Asgard(__name__)
+            first_app.configure(config)
+            with first_app:
+                table_manager.expr.QueryBuilderHelper(test_table).where_clause("key == null or value in ['a', 1.5]")
+            first_app.expression_cache.flush()
+            second_app = application.Asgard(__name__)
+            second_app.configure(config)
+            with second_app:
+                result = table_manager.expr.QueryBuilderHelper(test_table).where_clause(
+                    "key == null or value in ['a', 1.5]")
+            self.assertEqual(second_app.expression_cache.stats()["misses"], 0)
+            self.assertEqual(str(result), str(sa.or_(test_table.c.key == None, test_table.c.value.in_(["a", 1.5]))))
+            unwritable_app = application.Asgard(__name__)
+            unwritable_app.configure({"expressions": {"persistent_cache": os.path.join(directory, "a", "b.sqlite")}})
+            with unwritable_app:
+                table_manager.expr.QueryBuilderHelper(test_table).where_clause("id == 1")
+            unwritable_app.expression_cache.flush()
+            store = second_app.expression_cache._store
+            second_app.configure(config)
+            self.assertTrue(store._connection is None)
+            self.assertTrue(second_app.expression_cache._store is not store)
+            second_app.configure({})
+            self.assertTrue(second_app.expression_cache._store is None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_persistent_expression_cache_fork(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = table_manager.expr.TreeStore(os.path.join(directory, "saql.sqlite"))
+            parent_connection = store._connection
+            tree = table_manager.expr._compile("id == 1")
+            store.add("id == 1", tree)
+            # simulates a child process
+            store._pid = -1
+            store.add("id == 2", table_manager.expr._compile("id == 2"))
+            store.flush()
+            self.assertTrue(store._connection is not parent_connection)
+            self.assertEqual([x[0] for x in store.load(10)], ["id == 2"])
+            store.close()
+            self.assertTrue(store._connection is None)
+            parent_connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_variables_column_type(self):
+        id = TestCodedTableManager.i.create({"code": "abc"})
+        self.assertEqual(TestCodedTableManager.i.read(["code == :c", {"c": "abc"}], ["id"]), [{"id": id}])
+        self.assertEqual(TestCodedTableManager.i.read([":c == code", {"c": "abc"}], ["id"]), [{"id": id}])
+        self.assertEqual(TestCodedTableManager.i.read(["code in :c", {"c": ["abc", "x"]}], ["id"]), [{"id": id}])
+        self.assertEqual(TestCodedTableManager.i.count(["code == :c", {"c": "ABD"}]), 0)
+
+    def test_normalized_literals_column_type(self):
+        id = TestCodedTableManager.i.create({"code": "abc"})
+        self.assertEqual(TestCodedTableManager.i.read("code == 'abc'", ["id"]), [{"id": id}])
+        self.assertEqual(TestCodedTableManager.i.read("'abc' == code", ["id"]), [{"id": id}])
+        self.assertEqual(TestCodedTableManager.i.read("code in ['abc', 'x'] and id > 0", ["id"]), [{"id": id}])
+        self.assertEqual(TestCodedTableManager.i.read("code like 'ab' + '%'", ["id"]), [{"id": id}])
+
+class ReplicaTest(unittest.TestCase):
+    """Tests the routing of read-only transactions to the replicas."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.urls = {}
+        for name in ["primary", "r1", "r2"]:
+            self.urls[name] = "sqlite:///" + os.path.join(self.directory, name + ".sqlite")
+            engine = sa.create_engine(self.urls[name])
+            engine.execute("create table marker (name varchar(10))")
+            engine.execute("insert into marker values ('%s')" % name)
+            engine.dispose()
+        self.down_url = "sqlite:///" + os.path.join(self.directory, "missing", "r3.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_app(self, replicas):
+        replica_app = application.Asgard(__name__)
+        replica_app.configure({"database": {"sqlalchemy.url": self.urls["primary"], "replicas": replicas}})
+        return replica_app
+
+    def marker(self, replica_app, readonly):
+        with replica_app.transaction(readonly):
+            return replica_app.conn.execute("select name from marker").scalar()
+
+    def test_round_robin(self):
+        replica_app = self.create_app([self.urls["r1"], self.urls["r2"]])
+        self.assertEqual([self.marker(replica_app, True) for i in range(4)], ["r1", "r2", "r1", "r2"])
+        self.assertEqual(self.marker(replica_app, False), "primary")
+
+    def test_replica_down(self):
+        replica_app = self.create_app([self.down_url, self.urls["r2"]])
+        self.assertEqual([self.marker(replica_app, True) for i in range(3)], ["r2", "r2", "r2"])
+        self.assertEqual(list(replica_app._replicas_down.keys()), [0])
+
+    def test_primary_fallback(self):
+        replica_app = self.create_app([self.down_url])
+        self.assertEqual(self.marker(replica_app, True), "primary")
+        self.assertEqual(self.marker(replica_app, True), "primary")
+
+    def test_replica_pool_exhausted(self):
+        replica_app = self.create_app([self.urls["r1"]])
+        replica_app.replica_engines[0] = sa.create_engine(self.urls["r1"], poolclass=sa.pool.QueuePool, pool_size=1,
+            max_overflow=0, pool_timeout=0.1)
+        connection = replica_app._connect(True)
+        try:
+            self.assertEqual(self.marker(replica_app, True), "primary")
+            self.assertEqual(replica_app._replicas_down, {})
+        finally:
+            connection.close()
+        self.assertEqual(self.marker(replica_app, True), "r1")
+        replica_app.replica_engines[0].dispose()
+
+    def test_transactional(self):
+        replica_app = self.create_app([self.urls["r1"]])
+        read = lambda: replica_app.conn.execute("select name from marker").scalar()
+        self.assertEqual(replica_app.transactional(readonly=True)(read)(), "r1")
+        self.assertEqual(replica_app.transactional(read)(), "primary")
+
+    def test_add_url_rule(self):
+        replica_app = self.create_app([self.urls["r1"]])
+        replica_app.create_tables()
+        read = lambda: replica_app.conn.execute("select name from marker").scalar()
+        replica_app.web_app.add_url_rule("/replica", "replica", read, readonly=True)
+        replica_app.web_app.add_url_rule("/primary", "primary", read)
+        client = replica_app.web_app.test_client()
+        self.assertEqual(client.get("/replica").data, b"r1")
+        self.assertEqual(client.get("/primary").data, b"primary")
+
+    def test_result_cache(self):
+        replica_app = self.create_app([self.urls["r1"]])
+        marker_table = sa.Table("marker", sa.MetaData(), sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("name", sa.String(10)))
+        class MarkerManager(table_manager.table_manager(marker_table)):
+            result_cache = table_manager.ResultCache(size=10, ttl=60)
+        manager = MarkerManager()
+        with replica_app:
+            with replica_app.transaction(readonly=True):
+                self.assertEqual(manager.read(None, ["name"]), [{"name": "r1"}])
+            with replica_app.transaction():
+                self.assertEqual(manager.read(None, ["name"]), [{"name": "primary"}])
+            with replica_app.transaction(readonly=True):
+                self.assertEqual(manager.read(None, ["name"]), [{"name": "primary"}])
@@ -44,7 +44,8 @@ class WebApp(flask.Flask):
     def add_url_rule(self, rule, endpoint=None, view_func=None, *args, **kwargs):
         no_transaction = kwargs.get("no_transaction", False)
         if "no_transaction" in kwargs: del kwargs["no_transaction"]
-        trans_func = self.app.transactional(view_func) if not no_transaction else view_func
+        readonly = kwargs.pop("readonly", False)
+        trans_func = self.app.transactional(view_func, readonly) if not no_transaction else view_func
         trans_func.__name__ = view_func.__name__
         trans_func.__module__ = view_func.__module__
 
@@ -53,7 +54,8 @@ class WebApp(flask.Flask):
     def add_url_rule_for_json(self, rule, endpoint=None, view_func=None, *args, **kwargs):
         no_transaction = kwargs.get("no_transaction", False)
         if "no_transaction" in kwargs: del kwargs["no_transaction"]
-        trans_func = self.app.transactional(view_func) if not no_transaction else view_func
+        readonly = kwargs.pop("readonly", False)
+        trans_func = self.app.transactional(view_func, readonly) if not no_transaction else view_func
         return self.sjoh.add_url_rule_for_json(rule, endpoint, trans_func, *args, no_transaction=True, **kwargs)
 
     def json(self, rule, **options):
@@ -0,0 +1,70 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, Nicolas Vanhoren
+# 
+# Released under the MIT license
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Measures the time taken by the ``*_many_by_id()`` methods of the table managers for 10k to 100k ids, using
+different chunk sizes. Usage: ``python benchmarks/many_by_id.py [sqlalchemy_url]``
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import sys
+import time
+import sqlalchemy as sa
+import asgard
+
+app = asgard.Asgard(__name__)
+
+bench_table = sa.Table('bench_table', app.metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('value', sa.String(50)),
+)
+
+def run(url, count, chunk_size):
+    class BenchTableManager(asgard.table_manager(bench_table)):
+        id_chunk_size = chunk_size
+    manager = BenchTableManager()
+    app.configure({"database": {"sqlalchemy.url": url}})
+    app.metadata.drop_all(app.engine)
+    app.create_tables()
+    with app:
+        with app.transaction():
+            ids = manager.create_many([{"value": "a"} for i in range(count)], bulk=True)
+        timings = []
+        for name, func in [
+                ("read", lambda: manager.read_many_by_id(ids, ["value"])),
+                ("update", lambda: manager.update_many_by_id(ids, {"value": "b"})),
+                ("delete", lambda: manager.delete_many_by_id(ids)),
+            ]:
+            with app.transaction():
+                start = time.time()
+                func()
+                timings.append("%s: %.3fs" % (name, time.time() - start))
+    print("%6d ids, chunks of %6d: %s" % (count, chunk_size, ", ".join(timings)))
+
+if __name__ == "__main__":
+    url = sys.argv[1] if len(sys.argv) > 1 else "sqlite://"
+    for count in [10000, 50000, 100000]:
+        for chunk_size in [100, 500, 2000, 10000]:
+            run(url, count, chunk_size)
@@ -0,0 +1,117 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, Nicolas Vanhoren
+# 
+# Released under the MIT license
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compares the time taken to parse SAQL expressions on a cold cache by the hand-written parser and by the pyparsing
+grammar it replaced, after checking that both produce the same trees. Requires pyparsing.
+Usage: ``python benchmarks/saql_parser.py [count]``
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import sys
+import time
+import ast
+from pyparsing import *
+import asgard.expression as expression
+
+def define_pyparsing_parser():
+    ParserElement.enablePackrat()
+
+    identifier_part = Word(alphas + "_", alphanums + "_")
+    identifier = delimitedList(identifier_part, ".").setParseAction(lambda x: ('identifier', ".".join(x)))
+
+    variable = Combine(":" + Word(alphas + "_", alphanums + "_")).setParseAction(lambda x: ('variable', x[0][1:]))
+
+    boolean_literal = (Keyword("true") | Keyword("false")).setParseAction(lambda x: x[0] == "true")
+    integer_literal = Word(nums).setParseAction(lambda x: int(x[0]))
+    float_literal = Combine(Word(nums) + "." + Optional(Word(nums))).setParseAction(lambda x: float(x[0]))
+    string_literal = quotedString.setParseAction(lambda x: ast.literal_eval(x[0]))
+    null_literal = Keyword("null").setParseAction(lambda x: expression._none_val)
+
+    literal = (boolean_literal | string_literal | float_literal | integer_literal | null_literal).setParseAction(lambda x: ('literal', x[0]))
+
+    logical_or = Keyword("or")
+    logical_and = Keyword("and")
+    equality = Literal("==") | Literal("!=") | Keyword("in") | Keyword("like") | Keyword("ilike")
+    relational = Literal("<=") | Literal(">=") | Literal("<") | Literal(">")
+    additive = Literal("+") | Literal("-")
+    mult = Literal("*") | Literal("/") | Literal("%")
+    non = Keyword("not")
+
+    expr = Forward()
+
+    list_expr = ("[" + delimitedList(expr) + "]").setParseAction(lambda x: ('list', x[1:-1]))
+
+    rvalue = literal | identifier | variable | list_expr
+
+    def op1_action(x):
+        x = x[0]
+        return ('op1', x[0], x[1])
+
+    def op2_action(x):
+        x = x[0]
+        if len(x) == 1:
+            return x
+        return op2_action([[('op2', x[1], x[0], x[2])] + x[3:]])
+
+    expr << operatorPrecedence(rvalue, [
+            (additive, 1, opAssoc.RIGHT, op1_action),
+            (non, 1, opAssoc.RIGHT, op1_action),
+            (mult, 2, opAssoc.LEFT, op2_action),
+            (additive, 2, opAssoc.LEFT, op2_action),
+            (relational, 2, opAssoc.LEFT, op2_action),
+            (equality, 2, opAssoc.LEFT, op2_action),
+            (logical_and, 2, opAssoc.LEFT, op2_action),
+            (logical_or, 2, opAssoc.LEFT, op2_action),
+        ])
+
+    return expr + stringEnd
+
+templates = [
+    "id == %d",
+    "id == %d and (key != true or value in ['yes', 'no', 'maybe'])",
+    "not (status in [\"married\", \"single\"]) or credit > :min_value + %d",
+    "name like \"%%Smith%%\" and account != null and parent.code >= %d.5",
+    "-a * %d - +b / 2 %% 3 <= c and not d or e ilike 'x' and f < g",
+]
+
+def parse_all(parser, expressions):
+    return [parser.parseString(e)[0] for e in expressions]
+
+def run(count):
+    old_parser = define_pyparsing_parser()
+    expressions = [template % i for i in range(count) for template in templates]
+    assert parse_all(old_parser, expressions[:len(templates)]) == parse_all(expression._parser,
+        expressions[:len(templates)]), "The parsers produce different trees"
+    for name, parser in [("pyparsing", old_parser), ("hand-written", expression._parser)]:
+        ParserElement.resetCache()
+        start = time.time()
+        parse_all(parser, expressions)
+        elapsed = time.time() - start
+        print("%-12s %d expressions: %.3fs (%.1fus per expression)" % (name, len(expressions), elapsed,
+            elapsed / len(expressions) * 1000000))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
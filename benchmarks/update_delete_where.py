@@ -0,0 +1,90 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, Nicolas Vanhoren
+# 
+# Released under the MIT license
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Compares the ``update()`` and ``delete()`` methods of the table managers for an expression without foreign keys,
+applied with a direct where clause, and for an expression going through a foreign key, applied with an
+``id IN (subselect)`` clause containing the join. Both expressions match the same records.
+Usage: ``python benchmarks/update_delete_where.py [sqlalchemy_url]``
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import sys
+import time
+import sqlalchemy as sa
+import asgard
+
+app = asgard.Asgard(__name__)
+
+bench_parent_table = sa.Table('bench_parent_table', app.metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('name', sa.String(50)),
+)
+
+bench_table = sa.Table('bench_table', app.metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('code', sa.Integer, index=True),
+    sa.Column('value', sa.String(50)),
+    sa.Column('parent_id', sa.Integer, sa.ForeignKey('bench_parent_table.id')),
+)
+
+class BenchParentTableManager(asgard.table_manager(bench_parent_table)):
+    pass
+
+class BenchTableManager(asgard.table_manager(bench_table)):
+    pass
+
+EXPRESSIONS = [
+    ("direct", "code == :code"),
+    ("join", "code == :code and parent_id.name == :name"),
+]
+
+def run(name, expression, count, iterations):
+    manager = BenchTableManager()
+    app.metadata.drop_all(app.engine)
+    app.create_tables()
+    with app.transaction():
+        parent = BenchParentTableManager().create({"name": "p"})
+        manager.create_many([{"code": i, "value": "a", "parent_id": parent} for i in range(count)], bulk=True)
+    timings = []
+    for method, call in [
+            ("update", lambda i: manager.update([expression, {"code": i, "name": "p"}], {"value": "b"})),
+            ("delete", lambda i: manager.delete([expression, {"code": i, "name": "p"}])),
+        ]:
+        with app.transaction():
+            start = time.time()
+            for i in range(iterations):
+                call(i)
+            timings.append("%s: %.3fs" % (method, time.time() - start))
+    print("%-10s %6d rows, %d statements: %s" % (name, count, iterations, ", ".join(timings)))
+
+if __name__ == "__main__":
+    url = sys.argv[1] if len(sys.argv) > 1 else "sqlite://"
+    app.configure({"database": {"sqlalchemy.url": url}})
+    with app:
+        for count in [10000, 100000]:
+            for name, expression in EXPRESSIONS:
+                run(name, expression, count, 5000)
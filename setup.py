@@ -43,7 +43,6 @@ setup(name='asgard',
         'werkzeug>=0.9.6',
         'flask',
         'sqlalchemy',
-        'pyparsing',
         'pylru',
         'python-dateutil',
         'sjoh',
@@ -51,9 +50,11 @@ setup(name='asgard',
         ],
       extras_require={
         "bcrypt": ["bcrypt"],
+        "numpy": ["numpy"],
       },
       tests_require=[
         "bcrypt",
+        "numpy",
       ],
      )
 